@@ -30,10 +30,16 @@ setup(
         'Flask-Mako',
         'lxml'
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'simplejson': ['simplejson'],
+        'ujson': ['ujson'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update_users_file = presence_analyzer.cron:update_users_file
+    precompute_data = presence_analyzer.precompute:main
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of presence analyzer internals.
+
+Run with ``bin/flask-ctl benchmark <name> [args]`` or
+``python -m presence_analyzer.benchmarks <name> [args]``.
+"""
+import gc
+import json
+import multiprocessing
+import os.path
+import Queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+from presence_analyzer import stats, synthetic, users, utils, vectorized
+from presence_analyzer.main import app
+from presence_analyzer.store import PresenceDataBuilder
+
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
+)
+# seconds to wait for benchmark run in child process
+PROCESS_TIMEOUT = 600
+
+
+class BenchmarkError(Exception):
+    """
+    Benchmark run in child process failed or timed out.
+    """
+
+
+def run_in_process(target, args=(), timeout=PROCESS_TIMEOUT):
+    """
+    Returns result target(queue, *args) puts into queue, running it in
+    a child process. Raises BenchmarkError if the child exits without
+    result or doesn't finish in timeout seconds.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(queue,) + args)
+    process.start()
+    deadline = time.time() + timeout
+    try:
+        while True:
+            try:
+                return queue.get(timeout=1)
+            except Queue.Empty:
+                pass
+            if not process.is_alive():
+                try:
+                    # result could be put right before the check
+                    return queue.get(timeout=1)
+                except Queue.Empty:
+                    raise BenchmarkError(
+                        '{0} exited with code {1}'.format(
+                            target.__name__, process.exitcode,
+                        )
+                    )
+            if time.time() > deadline:
+                raise BenchmarkError('{0} timed out after {1}s'.format(
+                    target.__name__, timeout,
+                ))
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+def load(csv_path):
+    """
+    Loads given CSV file bypassing the cache.
+    """
+    app.config['DATA_CSV'] = os.path.abspath(csv_path)
+    utils.TIMESTAMPS['get_data'] = 0
+    return utils.get_data()
+
+
+def bench_memory(csv_path=SAMPLE_DATA_CSV):
+    """
+    Compares memory used by columnar store and legacy dict-of-dicts.
+    """
+    data = load(csv_path)
+    legacy = data.to_dict()
+    store_size = utils.deep_sizeof(data)
+    legacy_size = utils.deep_sizeof(legacy)
+    return {
+        'rows': data.rows_count,
+        'users': len(data),
+        'store_bytes': store_size,
+        'index_bytes': utils.deep_sizeof(
+            [user.weekdays for user in data.itervalues()]
+        ),
+        'legacy_bytes': legacy_size,
+        'ratio': float(legacy_size) / store_size,
+    }
+
+
+def bench_parse(csv_path=SAMPLE_DATA_CSV):
+    """
+    Compares throughput of fast CSV parser and strptime based one.
+    """
+    result = {}
+    for name, fast in (('strict', False), ('fast', True)):
+        with open(csv_path, 'r') as csvfile:
+            parse_stats = utils.parse_presence_lines(
+                csvfile, PresenceDataBuilder(), fast=fast,
+            )
+        result['rows'] = parse_stats['rows']
+        result[name + '_rows_per_second'] = int(
+            parse_stats['rows_per_second'],
+        )
+    result['speedup'] = (
+        float(result['fast_rows_per_second']) /
+        result['strict_rows_per_second']
+    )
+    return result
+
+
+def bench_ingest(users_count=1000, days=250, workers='1,2,4,8'):
+    """
+    Measures loading synthetic CSV file with different amounts of worker
+    processes.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'data.csv')
+        result = {
+            'rows': synthetic.write_presence_csv(
+                path, int(users_count), int(days),
+            ),
+            'cpus': multiprocessing.cpu_count(),
+        }
+        for count in [int(count) for count in workers.split(',')]:
+            _, seconds = timed(utils.PresenceLoader().load, path, None, count)
+            result['workers_{0}_seconds'.format(count)] = seconds
+            result['workers_{0}_speedup'.format(count)] = (
+                result['workers_1_seconds'] / seconds
+            )
+    finally:
+        shutil.rmtree(tmpdir)
+    return result
+
+
+def bench_snapshot(csv_path=SAMPLE_DATA_CSV):
+    """
+    Compares cold start parsing CSV file and restoring snapshot.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'data.snapshot')
+        csv_path = os.path.abspath(csv_path)
+        data, parse_seconds = timed(utils.PresenceLoader().load, csv_path)
+        _, write_seconds = timed(
+            utils.PresenceLoader().load, csv_path, path,
+        )
+        _, restore_seconds = timed(
+            utils.PresenceLoader().load, csv_path, path,
+        )
+        return {
+            'rows': data.rows_count,
+            'snapshot_bytes': os.path.getsize(path),
+            'parse_seconds': parse_seconds,
+            'parse_and_write_seconds': write_seconds,
+            'restore_seconds': restore_seconds,
+            'speedup': parse_seconds / restore_seconds,
+        }
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def timed(function, *args):
+    """
+    Returns (result, seconds) of function call. Like timeit, garbage
+    collection is disabled while timing.
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        started = time.time()
+        result = function(*args)
+        return result, time.time() - started
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def per_user_stats(data, from_rows=False):
+    """
+    Computes all metrics user by user, from precomputed weekday aggregates
+    or aggregating raw entries again.
+    """
+    result = {}
+    for user_id, user in data.iteritems():
+        weekdays = user.weekdays
+        if from_rows:
+            weekdays = stats.weekday_stats(user.dates, user.starts, user.ends)
+        result[user_id] = {
+            name: metric(weekdays)
+            for name, metric in stats.METRICS.iteritems()
+        }
+    return result
+
+
+def bench_vectorized(users_count=10000, days=20):
+    """
+    Compares all users statistics computed at once with NumPy and user by
+    user, both from raw entries and from precomputed weekday aggregates.
+    """
+    data = synthetic.build_data(int(users_count), int(days))
+    result = {'users': len(data), 'rows': data.rows_count}
+
+    _, result['aggregate_per_user_seconds'] = timed(lambda: [
+        stats.weekday_stats(user.dates, user.starts, user.ends)
+        for user in data.itervalues()
+    ])
+    _, result['aggregate_vectorized_seconds'] = timed(
+        vectorized.weekday_arrays, data, data.keys(),
+    )
+    result['aggregate_speedup'] = (
+        result['aggregate_per_user_seconds'] /
+        result['aggregate_vectorized_seconds']
+    )
+
+    _, result['results_per_user_rows_seconds'] = timed(
+        per_user_stats, data, True,
+    )
+    per_user, result['results_per_user_index_seconds'] = timed(
+        per_user_stats, data,
+    )
+    all_users, result['results_vectorized_seconds'] = timed(
+        vectorized.all_users_stats, data,
+    )
+    result['results_speedup'] = (
+        result['results_per_user_rows_seconds'] /
+        result['results_vectorized_seconds']
+    )
+    result['identical'] = all_users == per_user
+    return result
+
+
+def parse_users_tree(path):
+    """
+    Extracts users from XML file building the whole document tree,
+    the way users were read before iterparse.
+    """
+    # pylint: disable=no-member
+    tree = etree.parse(path)
+    url_base = "{}://{}".format(
+        tree.find('server').findtext('protocol'),
+        tree.find('server').findtext('host'),
+    )
+    return [
+        (
+            elem.get('id'),
+            elem.findtext('name'),
+            '{}{}'.format(url_base, elem.findtext('avatar')),
+        )
+        for elem in tree.findall('./users/user')
+    ]
+
+
+def _peak_memory(queue, function, path):
+    """
+    Puts peak memory growth (kB) and time of consuming function(path)
+    into queue. Run in separate process to measure only this call.
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    count = sum(1 for _ in function(path))
+    seconds = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((after - before, seconds, count))
+
+
+def measure_in_process(function, path):
+    """
+    Returns (peak_kb, seconds, count) of function measured in child process.
+    """
+    return run_in_process(_peak_memory, (function, path))
+
+
+def bench_users_xml(users_count=200000):
+    """
+    Compares peak memory of reading users XML with whole tree parsing
+    and with streaming iterparse.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'users.xml')
+        synthetic.write_users_xml(path, int(users_count))
+        result = {'file_bytes': os.path.getsize(path)}
+        for name, function in (
+                ('tree', parse_users_tree),
+                ('iterparse', users.iter_users)):
+            peak, seconds, count = measure_in_process(function, path)
+            result[name + '_peak_kb'] = peak
+            result[name + '_seconds'] = seconds
+            result['users'] = count
+    finally:
+        shutil.rmtree(tmpdir)
+    return result
+
+
+def api_payloads(data):
+    """
+    Returns {name: list of results} with payloads of every /api/v1 view
+    for all users of data.
+    """
+    payloads = {
+        name: [metric(user.weekdays) for user in data.itervalues()]
+        for name, metric in stats.METRICS.iteritems()
+    }
+    payloads['users'] = [[
+        {
+            'user_id': str(user_id),
+            'name': 'User {0}'.format(user_id),
+            'avatar': 'https://intranet.example.com/api/images/users/{0}'
+                      .format(user_id),
+        }
+        for user_id in data
+    ]]
+    payloads['batch'] = [per_user_stats(data)]
+    return payloads
+
+
+def bench_json(csv_path=SAMPLE_DATA_CSV, repeat=20):
+    """
+    Compares installed JSON encoders on payloads of every /api/v1 view.
+    """
+    payloads = api_payloads(load(csv_path))
+    result = {}
+    for name in utils.JSON_ENCODERS:
+        encoder = utils.json_encoder(name)
+        if name != 'json' and encoder is utils.dumps:
+            result[name] = 'not installed'
+            continue
+        for shape, results in payloads.iteritems():
+            _, seconds = timed(lambda: [
+                encoder(payload)
+                for _ in xrange(int(repeat))
+                for payload in results
+            ])
+            result['{0}_{1}_seconds'.format(name, shape)] = seconds
+            if name != 'json':
+                result['{0}_{1}_speedup'.format(name, shape)] = (
+                    result['json_{0}_seconds'.format(shape)] / seconds
+                )
+    return result
+
+
+VIEW_URLS = (
+    ('mean_time_weekday', '/api/v1/mean_time_weekday/{0}'),
+    ('presence_weekday', '/api/v1/presence_weekday/{0}'),
+    ('presence_start_end', '/api/v1/presence_start_end/{0}'),
+    ('standard_deviation', '/api/v1/standard_deviation/{0}'),
+    ('users_v2', '/api/v2/users'),
+)
+
+
+def percentile(values, fraction):
+    """
+    Returns value below which given fraction of sorted values lies.
+    """
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def view_latencies(user_ids):
+    """
+    Measures latency of every view in VIEW_URLS with cold caches.
+    """
+    client = app.test_client()
+    result = {}
+    for name, url in VIEW_URLS:
+        latencies = []
+        for user_id in user_ids:
+            for cache in utils.LRU_CACHES.itervalues():
+                cache.clear()
+            started = time.time()
+            resp = client.get(url.format(user_id))
+            latencies.append(time.time() - started)
+            if resp.status_code != 200:
+                raise AssertionError('{0} returned {1}'.format(
+                    url.format(user_id), resp.status_code,
+                ))
+        latencies.sort()
+        result[name + '_mean_seconds'] = sum(latencies) / len(latencies)
+        result[name + '_p95_seconds'] = percentile(latencies, 0.95)
+    return result
+
+
+def _ingest_and_serve(queue, csv_path, xml_path, samples):
+    """
+    Puts ingest time, memory growth (kB) and view latencies into queue.
+    Run in separate process, so every data size starts from scratch.
+    """
+    app.config.update({
+        'DATA_CSV': csv_path,
+        'USERS_XML_FILE': xml_path,
+        'DATA_SNAPSHOT': None,
+    })
+    utils.TIMESTAMPS.clear()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    data, ingest_seconds = timed(utils.get_data)
+    result = {
+        'rows': data.rows_count,
+        'users': len(data),
+        'ingest_seconds': ingest_seconds,
+        'ingest_peak_kb': (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        ),
+        'store_bytes': data.nbytes,
+    }
+    _, result['users_xml_seconds'] = timed(users.get_users_index)
+    user_ids = sorted(data)
+    user_ids = random.Random(0).sample(user_ids, min(samples, len(user_ids)))
+    result.update(view_latencies(user_ids))
+    queue.put(result)
+
+
+def check_thresholds(result, thresholds):
+    """
+    Returns descriptions of results exceeding maximal values given as
+    ``{result key: max value}``.
+    """
+    return [
+        '{0} = {1} exceeds {2}'.format(key, result.get(key), limit)
+        for key, limit in sorted(thresholds.iteritems())
+        if result.get(key) is None or result[key] > limit
+    ]
+
+
+def bench_scaling(sizes='10000,1000000,10000000', days=250, noise=0.01,
+                  samples=20, output='', thresholds='',
+                  timeout=PROCESS_TIMEOUT):
+    """
+    Measures ingest time and memory, and latency of views on synthetic
+    data of given amounts of rows, every size in a fresh process.
+
+    Results are saved as JSON to output file if given. Thresholds is JSON
+    file with maximal values of results, exceeded ones are listed in
+    regressions, together with sizes which failed or timed out.
+    """
+    result = {}
+    failures = []
+    for size in [int(size) for size in str(sizes).split(',')]:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            csv_path = os.path.join(tmpdir, 'data.csv')
+            xml_path = os.path.join(tmpdir, 'users.xml')
+            users_count = max(1, size // int(days))
+            synthetic.write_presence_csv(
+                csv_path, users_count, int(days), noise=float(noise),
+            )
+            synthetic.write_users_xml(xml_path, users_count)
+            size_result = run_in_process(
+                _ingest_and_serve,
+                (csv_path, xml_path, int(samples)),
+                float(timeout),
+            )
+        except BenchmarkError as error:
+            failures.append('rows_{0} failed: {1}'.format(size, error))
+            continue
+        finally:
+            shutil.rmtree(tmpdir)
+        for key, value in size_result.iteritems():
+            result['rows_{0}_{1}'.format(size, key)] = value
+    if failures:
+        result['regressions'] = failures
+    if thresholds:
+        with open(thresholds) as thresholds_file:
+            result['regressions'] = failures + check_thresholds(
+                result, json.load(thresholds_file),
+            )
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(result, output_file, indent=2, sort_keys=True)
+    return result
+
+
+BENCHMARKS = {
+    'memory': bench_memory,
+    'ingest': bench_ingest,
+    'json': bench_json,
+    'parse': bench_parse,
+    'scaling': bench_scaling,
+    'snapshot': bench_snapshot,
+    'vectorized': bench_vectorized,
+    'users_xml': bench_users_xml,
+}
+
+
+def run(name, *args):
+    """
+    Runs benchmark with given name and arguments and prints its results.
+    """
+    result = BENCHMARKS[name](*args)
+    for key in sorted(result):
+        print '{0:>32}: {1}'.format(key, result[key])
+    return result
+
+
+if __name__ == '__main__':
+    # benchmark name is the first command line argument
+    # pylint: disable=no-value-for-parameter
+    sys.exit(1 if run(*sys.argv[1:]).get('regressions') else 0)
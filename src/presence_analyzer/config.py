@@ -13,3 +13,7 @@ USERS_XML_FILE = os.path.join(
 USERS_TEST_XML_FILE = os.path.join(
     USERS_XML_DIR, 'users_test.xml'
 )
+# seconds to wait for users XML server, attempts and delay before retry
+USERS_XML_TIMEOUT = 30
+USERS_XML_ATTEMPTS = 3
+USERS_XML_RETRY_DELAY = 5
@@ -2,26 +2,170 @@
 """
 Cron function
 """
-
+import httplib
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
 import urllib2
 
+from lxml import etree
+
 from presence_analyzer.config import (
+    USERS_XML_ATTEMPTS,
     USERS_XML_FILE,
+    USERS_XML_RETRY_DELAY,
+    USERS_XML_TIMEOUT,
     USERS_XML_URL,
 )
+from presence_analyzer.users import iter_users
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CHUNK_SIZE = 64 * 1024
+# validators of the last download are kept next to the file
+STATE_SUFFIX = '.http.json'
+
+
+class UsersSyncError(Exception):
+    """
+    Users XML file could not be downloaded.
+    """
+
+
+def read_state(path):
+    """
+    Returns ETag and Last-Modified of downloaded file, empty dict if the
+    file or its state is missing.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path + STATE_SUFFIX) as state_file:
+            return json.load(state_file)
+    except (EnvironmentError, ValueError):
+        return {}
+
+
+def write_state(path, state):
+    """
+    Atomically writes state of downloaded file.
+    """
+    tmp_path = path + STATE_SUFFIX + '.tmp'
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.rename(tmp_path, path + STATE_SUFFIX)
+
+
+def validate_users_xml(path):
+    """
+    Checks if file is users XML readable by users index.
+    Returns amount of users.
+    """
+    try:
+        count = sum(1 for _ in iter_users(path))
+    except (etree.XMLSyntaxError, ValueError) as error:
+        raise UsersSyncError('Invalid users XML: {0}'.format(error))
+    if not count:
+        raise UsersSyncError('Users XML contains no users')
+    return count
+
+
+def download(url, path, state, timeout):
+    """
+    Downloads users XML unless it's not modified since the last download.
+
+    Body is streamed to a temporary file in the target directory, which
+    is validated and renamed over path. Returns new state, or None if the
+    file is not modified.
+    """
+    request = urllib2.Request(url)
+    if state.get('etag'):
+        request.add_header('If-None-Match', state['etag'])
+    if state.get('last_modified'):
+        request.add_header('If-Modified-Since', state['last_modified'])
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            return None
+        raise
+    new_state = {
+        'etag': response.info().getheader('ETag'),
+        'last_modified': response.info().getheader('Last-Modified'),
+    }
+
+    handle, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.users-',
+    )
+    try:
+        with os.fdopen(handle, 'wb') as tmp_file:
+            try:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    tmp_file.write(chunk)
+            finally:
+                response.close()
+        count = validate_users_xml(tmp_path)
+        # mkstemp creates file readable by owner only
+        mode = os.stat(path).st_mode if os.path.exists(path) else 0o644
+        os.chmod(tmp_path, mode & 0o7777)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    log.info('Downloaded %d users from %s', count, url)
+    return new_state
+
+
+def sync_users_file(url=USERS_XML_URL, path=USERS_XML_FILE,
+                    timeout=USERS_XML_TIMEOUT, attempts=USERS_XML_ATTEMPTS,
+                    retry_delay=USERS_XML_RETRY_DELAY):
+    """
+    Updates users XML file with conditional GET.
+
+    Connection errors, timeouts, server errors and invalid XML are retried
+    up to attempts times, waiting retry_delay seconds (doubled after every
+    attempt). File is never left half-written. Returns True if the file
+    was replaced, False if it's not modified. Raises UsersSyncError if all
+    attempts failed.
+    """
+    state = read_state(path)
+    for attempt in range(1, attempts + 1):
+        try:
+            new_state = download(url, path, state, timeout)
+        except urllib2.HTTPError as error:
+            if error.code < 500:
+                raise UsersSyncError('{0} returned {1}'.format(
+                    url, error.code,
+                ))
+            failure = error
+        except (urllib2.URLError, httplib.HTTPException, socket.error,
+                UsersSyncError) as error:
+            failure = error
+        else:
+            if new_state is None:
+                log.info('%s is not modified', url)
+                return False
+            write_state(path, new_state)
+            return True
+        log.warning('Attempt %d of %d to download %s failed: %s',
+                    attempt, attempts, url, failure)
+        if attempt < attempts:
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+    raise UsersSyncError('Downloading {0} failed: {1}'.format(url, failure))
 
 
 def update_users_file():
     """
     Download actual users data XML.
     """
-    remote_file = urllib2.urlopen(USERS_XML_URL)
-    local_file = open(USERS_XML_FILE, "w")
-    data = remote_file.read()
-    local_file.write(data)
-    local_file.close()
-    remote_file.close()
-    return data
+    logging.basicConfig(level=logging.INFO)
+    sync_users_file()
 
 
 if __name__ == '__main__':
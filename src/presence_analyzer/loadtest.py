@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent load test of API views.
+
+Traffic is a weighted mix of API requests sent by a number of client
+threads. It's sent either straight to the WSGI application, to paster's
+threaded HTTP server started in-process with given threadpool settings,
+or to a server already running at given URL.
+"""
+import json
+import random
+import threading
+import time
+import urllib2
+from bisect import bisect_right
+from contextlib import contextmanager
+
+from presence_analyzer.benchmarks import percentile
+
+# (path template, weight); {0} is a user id, {1} comma separated user ids
+MIX = (
+    ('/api/v1/presence_weekday/{0}', 25),
+    ('/api/v1/mean_time_weekday/{0}', 20),
+    ('/api/v1/presence_start_end/{0}', 20),
+    ('/api/v1/standard_deviation/{0}', 15),
+    ('/api/v2/users', 10),
+    ('/api/v1/users', 5),
+    ('/api/v1/batch?user_ids={1}', 5),
+)
+BATCH_USERS = 10
+
+
+def request_paths(user_ids, count, seed=0):
+    """
+    Returns list of count request paths drawn from MIX.
+    """
+    rng = random.Random(seed)
+    bounds = []
+    total = 0
+    for _, weight in MIX:
+        total += weight
+        bounds.append(total)
+    paths = []
+    for _ in xrange(count):
+        point = rng.uniform(0, total - 1e-9)
+        template = MIX[bisect_right(bounds, point)][0]
+        paths.append(template.format(
+            rng.choice(user_ids),
+            ','.join(str(user_id) for user_id in rng.sample(
+                user_ids, min(BATCH_USERS, len(user_ids)),
+            )),
+        ))
+    return paths
+
+
+def wsgi_sender(application):
+    """
+    Returns function sending request straight to WSGI application and
+    returning status code. Every thread gets its own test client.
+    """
+    local = threading.local()
+
+    def send(path):
+        """
+        Sends GET request.
+        """
+        if not hasattr(local, 'client'):
+            local.client = application.test_client()
+        return local.client.get(path).status_code
+    return send
+
+
+def http_sender(base_url, timeout=30):
+    """
+    Returns function sending request to HTTP server and returning status
+    code.
+    """
+    def send(path):
+        """
+        Sends GET request.
+        """
+        try:
+            response = urllib2.urlopen(base_url + path, timeout=timeout)
+        except urllib2.HTTPError as error:
+            return error.code
+        response.read()
+        return response.getcode()
+    return send
+
+
+def run_level(send, paths, concurrency):
+    """
+    Sends requests to all paths from given amount of threads.
+
+    Returns throughput, latency percentiles (in seconds) and amount of
+    failed requests (other than 200 and 304 or raising an exception).
+    """
+    pending = iter(paths)
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def client():
+        """
+        Sends requests until all paths are used.
+        """
+        while True:
+            with lock:
+                path = next(pending, None)
+            if path is None:
+                return
+            started = time.time()
+            try:
+                ok = send(path) in (200, 304)
+            except Exception:  # pylint: disable=broad-except
+                ok = False
+            latency = time.time() - started
+            with lock:
+                latencies.append(latency)
+                errors[0] += not ok
+
+    started = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - started
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': seconds,
+        'throughput': len(latencies) / max(seconds, 1e-9),
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+@contextmanager
+def paste_server(application, workers, spawn_if_under, max_requests):
+    """
+    Runs paster's threaded HTTP server on a free local port, yields its
+    base URL. Paster needs spawn_if_under to be lower than workers.
+    """
+    from paste import httpserver  # pylint: disable=import-error
+    server = httpserver.serve(
+        application,
+        host='127.0.0.1',
+        port=0,
+        start_loop=False,
+        use_threadpool=True,
+        threadpool_workers=workers,
+        threadpool_options={
+            'spawn_if_under': min(spawn_if_under, workers - 1),
+            'max_requests': max_requests,
+        },
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://{0}:{1}'.format(*server.server_address[:2])
+    finally:
+        # serve_forever checks the flag at least every second
+        server.running = False
+        thread.join()
+        server.socket.close()
+
+
+def load_test(application, concurrency_levels, requests, workers=(),
+              url=None, spawn_if_under=5, max_requests=200, seed=0):
+    """
+    Runs load test for every concurrency level and threadpool setting.
+
+    Without url and workers requests are sent straight to application.
+    Every workers value starts paster server with such threadpool.
+    Returns list of run_level results with 'setting' added.
+    """
+    if url:
+        user_ids = [
+            user['user_id'] for user in
+            json.load(urllib2.urlopen(url + '/api/v1/users'))
+        ]
+    else:
+        from presence_analyzer.utils import get_data
+        user_ids = sorted(get_data())
+    paths = request_paths(user_ids, requests, seed)
+
+    results = []
+
+    def run_levels(setting, send):
+        """
+        Runs all concurrency levels with given sender.
+        """
+        for concurrency in concurrency_levels:
+            result = run_level(send, paths, concurrency)
+            result['setting'] = setting
+            results.append(result)
+
+    if url:
+        run_levels('external', http_sender(url))
+    elif not workers:
+        run_levels('wsgi', wsgi_sender(application))
+    for count in workers:
+        with paste_server(application, count, spawn_if_under,
+                          max_requests) as base_url:
+            run_levels('threadpool_workers={0}'.format(count),
+                       http_sender(base_url))
+    return results
+
+
+def report(results):
+    """
+    Formats results as a table, latencies in milliseconds.
+    """
+    lines = [
+        '{0:<24} {1:>5} {2:>7} {3:>6} {4:>9} {5:>8} {6:>8} {7:>8}'.format(
+            'setting', 'conc', 'reqs', 'errors', 'req/s', 'p50 ms',
+            'p95 ms', 'p99 ms',
+        ),
+    ]
+    for result in results:
+        lines.append(
+            '{setting:<24} {concurrency:>5} {requests:>7} {errors:>6} '
+            '{throughput:>9.1f} {0:>8.2f} {1:>8.2f} {2:>8.2f}'.format(
+                result['p50'] * 1000,
+                result['p95'] * 1000,
+                result['p99'] * 1000,
+                **result
+            )
+        )
+    return '\n'.join(lines)
@@ -6,5 +6,9 @@ from flask import Flask
 # pylint: disable=no-name-in-module,import-error
 from flask.ext.mako import MakoTemplates
 
+from presence_analyzer.profiling import ProfilerMiddleware
+
 app = Flask(__name__)  # pylint: disable=invalid-name
 mako = MakoTemplates(app)
+# inactive unless PROFILE option is set
+app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app.config)
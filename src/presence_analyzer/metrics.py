@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Application metrics exposed in Prometheus text format.
+
+Counters, gauges and histograms are kept in process memory and rendered
+on request, see render(). Every request is counted and timed by
+request hooks registered here.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request
+
+from presence_analyzer.main import app
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+REGISTRY = []
+COLLECTORS = []
+
+
+def format_value(value):
+    """
+    Formats sample value, floats keep full precision.
+    """
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(labels):
+    """
+    Formats ``{name="value",...}`` label set, empty string for no labels.
+    """
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(
+            name,
+            unicode(value).encode('utf-8').replace('\\', r'\\')
+            .replace('\n', r'\n').replace('"', r'\"'),
+        )
+        for name, value in labels
+    ))
+
+
+class Metric(object):
+    """
+    Base of metrics with values kept per label values.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        """
+        Returns tuple of label values in order of label names.
+        """
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """
+        Returns list of (sample name, label pairs, value) tuples.
+        """
+        with self.lock:
+            return [
+                (self.name, zip(self.labels, key), value)
+                for key, value in sorted(self.values.iteritems())
+            ]
+
+    def clear(self):
+        """
+        Removes all values.
+        """
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing value.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        Increases counter of given labels.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value which can go up and down.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """
+        Sets value of given labels.
+        """
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Observations counted in cumulative buckets, with their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """
+        Records single observation.
+        """
+        key = self.key(labels)
+        with self.lock:
+            try:
+                counts, total = self.values[key]
+            except KeyError:
+                counts = [0] * (len(self.buckets) + 1)
+                total = 0.0
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = counts, total + value
+
+    def samples(self):
+        with self.lock:
+            values = sorted(
+                (key, (list(counts), total))
+                for key, (counts, total) in self.values.iteritems()
+            )
+        result = []
+        for key, (counts, total) in values:
+            labels = zip(self.labels, key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                result.append((
+                    self.name + '_bucket',
+                    labels + [('le', format_value(float(bound)))],
+                    cumulative,
+                ))
+            result.append((self.name + '_sum', labels, total))
+            result.append((self.name + '_count', labels, cumulative))
+        return result
+
+
+def collector(function):
+    """
+    Registers function returning list of metrics computed on demand.
+    """
+    COLLECTORS.append(function)
+    return function
+
+
+def render():
+    """
+    Returns all metrics in Prometheus text exposition format.
+    """
+    metrics = list(REGISTRY)
+    for function in COLLECTORS:
+        metrics.extend(function())
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP {0} {1}'.format(
+            metric.name, metric.documentation,
+        ))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append('{0}{1} {2}'.format(
+                name, format_labels(labels), format_value(value),
+            ))
+    return '\n'.join(lines) + '\n'
+
+
+class Snapshot(Metric):
+    """
+    Metric with values supplied by a collector, not kept in REGISTRY.
+    """
+
+    def __init__(self, kind, name, documentation, labels, values):
+        # pylint: disable=super-init-not-called
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = values
+        self.lock = threading.Lock()
+
+
+REQUESTS = Counter(
+    'presence_http_requests_total',
+    'HTTP requests by endpoint, method and status code.',
+    ('endpoint', 'method', 'status'),
+)
+REQUEST_DURATION = Histogram(
+    'presence_http_request_duration_seconds',
+    'Time spent handling HTTP requests by endpoint.',
+    ('endpoint',),
+)
+DATA_PARSE_DURATION = Histogram(
+    'presence_data_parse_duration_seconds',
+    'Time spent parsing presence CSV lines.',
+)
+DATA_ROWS = Gauge(
+    'presence_data_rows',
+    'Presence entries currently loaded.',
+)
+DATA_ROWS_PARSED = Counter(
+    'presence_data_rows_parsed_total',
+    'Presence CSV rows parsed successfully.',
+)
+DATA_ROWS_REJECTED = Counter(
+    'presence_data_rows_rejected_total',
+    'Presence CSV rows rejected: with wrong amount of fields or invalid '
+    'values.',
+    ('reason',),
+)
+MEMORIZE_HITS = Counter(
+    'presence_memorize_hits_total',
+    'memorize calls answered from cache, including stale values.',
+    ('function',),
+)
+MEMORIZE_MISSES = Counter(
+    'presence_memorize_misses_total',
+    'memorize calls which had to wait for rebuild.',
+    ('function',),
+)
+MEMORIZE_REBUILD_DURATION = Histogram(
+    'presence_memorize_rebuild_duration_seconds',
+    'Time spent rebuilding memorized values.',
+    ('function',),
+)
+MEMORIZE_LOCK_WAIT = Histogram(
+    'presence_memorize_lock_wait_seconds',
+    'Time spent waiting for memorize lock.',
+    ('function',),
+)
+USERS_XML_PARSE_DURATION = Histogram(
+    'presence_users_xml_parse_duration_seconds',
+    'Time spent parsing users XML file.',
+)
+
+
+@app.before_request
+def start_timer():
+    """
+    Remembers when request handling started.
+    """
+    g.metrics_started = time.time()
+
+
+@app.after_request
+def remember_status(response):
+    """
+    Remembers status code of response for record_request.
+    """
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request(_exc=None):
+    """
+    Counts and times finished request; unhandled errors are counted as 500.
+    """
+    started = getattr(g, 'metrics_started', None)
+    if started is None:
+        return
+    endpoint = request.endpoint or 'none'
+    REQUESTS.inc(
+        endpoint=endpoint,
+        method=request.method,
+        status=getattr(g, 'metrics_status', 500),
+    )
+    REQUEST_DURATION.observe(time.time() - started, endpoint=endpoint)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Offline precomputation of presence data.
+
+Parses DATA_CSV and writes its snapshot (see presence_analyzer.snapshot)
+to DATA_SNAPSHOT: columns of all users and their weekday aggregates,
+everything the views are computed from. Web workers write the snapshot
+only when they load the file from scratch, refreshing it as lines are
+appended is left to this job. Once precompute_data is scheduled (e.g.
+from cron), set DATA_SNAPSHOT_WRITE = False in application config, so
+workers only restore it and parse lines appended since the last run.
+INGEST_WORKERS option sets amount of parsing processes, web workers
+always parse in their own process.
+
+Usage: precompute_data [CONFIG], CONFIG defaults to parts/etc/deploy.cfg
+of the buildout.
+"""
+import os
+import sys
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import PresenceLoader
+
+
+def precompute(csv_path, snapshot_path, workers=1):
+    """
+    Writes snapshot of presence CSV file, parsing only lines appended
+    since the existing snapshot was made. Returns PresenceLoader.
+    """
+    loader = PresenceLoader()
+    loader.load(csv_path, snapshot_path, workers)
+    return loader
+
+
+def main(argv=None):
+    """
+    Precomputes presence data of application config.
+    """
+    args = sys.argv[1:] if argv is None else argv
+    if args:
+        config = os.path.abspath(args[0])
+    else:
+        # the same config as served app, wherever cron runs it from
+        from presence_analyzer import script
+        config = script.abspath(script.DEPLOY_CFG)
+    app.config.from_pyfile(config)
+    if not app.config.get('DATA_SNAPSHOT'):
+        print 'DATA_SNAPSHOT is not set'
+        return 1
+    loader = precompute(
+        app.config['DATA_CSV'],
+        app.config['DATA_SNAPSHOT'],
+        app.config.get('INGEST_WORKERS', 1),
+    )
+    stats = loader.last_stats
+    print 'Snapshot {0} has {1} rows of {2} users, parsed {3} new rows, ' \
+        'rejected {4}'.format(
+            app.config['DATA_SNAPSHOT'], loader.data.rows_count,
+            len(loader.data), stats['rows'],
+            stats['skipped'] + stats['invalid'],
+        )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of requests with cProfile.
+
+ProfilerMiddleware wraps WSGI application. With PROFILE option set,
+requests with PROFILE_HEADER header equal to PROFILE_TOKEN (header is
+ignored without token) and a PROFILE_SAMPLE_RATE fraction of all requests
+are profiled. Profiles are written to PROFILE_DIR in pstats format, at
+most PROFILE_MAX_FILES newest ones are kept.
+"""
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import random
+import re
+import time
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SUFFIX = '.prof'
+DEFAULT_HEADER = 'X-Profile'
+DEFAULT_MAX_FILES = 100
+
+
+def profile_name(environ, seconds):
+    """
+    Returns file name of profile: time, method, path and duration.
+    """
+    path = re.sub(r'[^A-Za-z0-9]+', '_', environ.get('PATH_INFO', ''))
+    return '{0}-{1:06d}-{2}-{3}-{4}ms{5}'.format(
+        time.strftime('%Y%m%d%H%M%S'),
+        random.randint(0, 999999),
+        environ.get('REQUEST_METHOD', 'GET'),
+        path.strip('_') or 'root',
+        int(seconds * 1000),
+        SUFFIX,
+    )
+
+
+class ProfilerMiddleware(object):
+    """
+    WSGI middleware running cProfile around requests chosen by config.
+
+    Body of profiled response is generated inside the profiler, so
+    streamed responses are buffered.
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+
+    def should_profile(self, environ):
+        """
+        Checks if request is to be profiled.
+        """
+        if not self.config.get('PROFILE'):
+            return False
+        header = self.config.get('PROFILE_HEADER', DEFAULT_HEADER)
+        value = environ.get('HTTP_' + header.upper().replace('-', '_'))
+        token = self.config.get('PROFILE_TOKEN')
+        if value and token and hmac.compare_digest(str(value), str(token)):
+            return True
+        return random.random() < self.config.get('PROFILE_SAMPLE_RATE', 0)
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.app(environ, start_response)
+
+        body = []
+        profiler = cProfile.Profile()
+        started = time.time()
+
+        def run():
+            """
+            Calls application and collects response body.
+            """
+            app_iter = self.app(environ, start_response)
+            try:
+                body.extend(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+
+        profiler.runcall(run)
+        self.save(profiler, profile_name(environ, time.time() - started))
+        return body
+
+    def save(self, profiler, name):
+        """
+        Writes profile and removes the oldest ones over the limit.
+        Failures are only logged, they never break the request.
+        """
+        directory = self.config.get('PROFILE_DIR')
+        if not directory:
+            log.warning('PROFILE_DIR is not set, profile dropped')
+            return
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            profiler.dump_stats(os.path.join(directory, name))
+            max_files = self.config.get('PROFILE_MAX_FILES', DEFAULT_MAX_FILES)
+            # names start with time, so they sort from the newest one
+            names = sorted(
+                (name for name in os.listdir(directory)
+                 if name.endswith(SUFFIX)),
+                reverse=True,
+            )
+            for old in names[max_files:]:
+                os.remove(os.path.join(directory, old))
+        except EnvironmentError:
+            log.exception('Saving profile %s failed', name)
+
+
+def list_profiles(directory):
+    """
+    Returns profiles from directory, newest first, as dicts with name,
+    path, size, and total time and calls recorded in the profile.
+    """
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith(SUFFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stats = pstats.Stats(path)
+        except (EnvironmentError, ValueError, EOFError):
+            continue
+        profiles.append({
+            'name': name,
+            'path': path,
+            'size': os.path.getsize(path),
+            'seconds': stats.total_tt,
+            'calls': stats.total_calls,
+        })
+    return profiles
+
+
+def summarize(path, sort='cumulative', limit=20, stream=None):
+    """
+    Prints the most expensive functions of profile.
+    """
+    stats = pstats.Stats(path, stream=stream)
+    stats.strip_dirs().sort_stats(sort).print_stats(int(limit))
@@ -26,10 +26,15 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warm_up=True):
+    from presence_analyzer import app, warmup
     app.config.from_pyfile(abspath(config))
+    app.config.setdefault('PROFILE_DIR', abspath('var', 'log', 'profiles'))
     app.debug = debug
+    # preload caches of served app, /readyz reports 503 until it's done;
+    # flask-ctl helpers pass warm_up=False
+    if warm_up and app.config.get('WARM_UP'):
+        warmup.start(background=app.config.get('WARM_UP_BACKGROUND', True))
     return app
 
 
@@ -44,7 +49,7 @@ def make_debug(global_conf={}, **conf):
 def make_shell():
     """Interactive Flask Shell"""
     from flask import request
-    app = make_app()
+    app = make_app(warm_up=False)
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
@@ -110,4 +115,68 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl benchmark memory [--args=path/to/data.csv]
+    def action_benchmark(name=('n', 'memory'), args=('a', '')):
+        """Run one of presence_analyzer.benchmarks.
+
+        Options:
+         - 'name' is the benchmark name, e.g. 'memory' or 'scaling'
+         - 'args' space separated benchmark arguments, e.g. CSV file
+
+        Exits with status 1 if results exceed regression thresholds.
+        """
+        import shlex
+        from presence_analyzer import benchmarks
+        make_app(warm_up=False)
+        result = benchmarks.run(name, *shlex.split(args))
+        if result.get('regressions'):
+            sys.exit(1)
+
+    # bin/flask-ctl loadtest [--concurrency=1,10,50] [--workers=10,50]
+    def action_loadtest(concurrency=('c', '1,10,50'), requests=('r', 1000),
+                        workers=('w', ''), url=('u', ''),
+                        spawn_if_under=5, max_requests=200):
+        """Load test API views with concurrent traffic.
+
+        Options:
+         - 'concurrency' comma separated amounts of client threads
+         - 'requests' amount of requests at every concurrency level
+         - 'workers' comma separated paster threadpool_workers settings,
+           requests go straight to WSGI application without it
+         - 'url' of already running server, e.g. http://localhost:8080
+         - 'spawn_if_under' and 'max_requests' paster threadpool options
+        """
+        from presence_analyzer import loadtest
+        app = make_app(warm_up=False)
+        print loadtest.report(loadtest.load_test(
+            app,
+            [int(level) for level in concurrency.split(',')],
+            requests,
+            workers=[int(count) for count in workers.split(',') if count],
+            url=url.rstrip('/') or None,
+            spawn_if_under=spawn_if_under,
+            max_requests=max_requests,
+        ))
+
+    # bin/flask-ctl profiles [--name=file.prof]
+    def action_profiles(name=('n', ''), sort=('s', 'cumulative'),
+                        limit=('l', 20)):
+        """List or summarize request profiles.
+
+        Options:
+         - 'name' profile file to summarize, all profiles are listed
+           without it
+         - 'sort' pstats sort key, e.g. 'cumulative' or 'tottime'
+         - 'limit' amount of functions to show
+        """
+        from presence_analyzer import profiling
+        directory = make_app(warm_up=False).config['PROFILE_DIR']
+        if name:
+            profiling.summarize(os.path.join(directory, name), sort, limit)
+            return
+        for profile in profiling.list_profiles(directory):
+            print '{name}  {seconds:8.3f}s  {calls:9d} calls'.format(
+                **profile
+            )
+
     werkzeug.script.run()
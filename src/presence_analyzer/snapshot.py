@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of parsed presence data.
+
+Snapshot keeps date, start and end columns of all users, their weekday
+aggregates and identity of the CSV file it was made from: its inode, size,
+mtime, amount of consumed bytes, their SHA-1 and SHA-1 of the last of them
+(see tail_digest). Loading it is a few bulk
+reads instead of parsing the whole CSV again.
+
+Layout, all numbers in native byte order::
+
+    MAGIC, FORMAT_VERSION and header length (struct HEADER)
+    JSON header
+    dates, starts and ends of all users (array TYPECODE)
+    weekday aggregates of all users, AGGREGATES per weekday (array 'd')
+"""
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from presence_analyzer.stats import RunningStats, WeekdayStats
+from presence_analyzer.store import TYPECODE, PresenceData, UserPresence
+
+MAGIC = 'PASNAP'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('=6sII')
+# count, total, start total, start m2, end total, end m2
+AGGREGATES = 6
+CHUNK_SIZE = 1024 * 1024
+# consumed bytes compared to tell appended file from rewritten one
+TAIL_SIZE = 4096
+
+
+class SnapshotError(ValueError):
+    """
+    Snapshot file is malformed or made by incompatible version.
+    """
+
+
+def file_digest(path, length, digest=None, start=0):
+    """
+    Returns SHA-1 object (new or given one) updated with length bytes
+    of file from start offset.
+    """
+    if digest is None:
+        digest = hashlib.sha1()
+    with open(path, 'rb') as datafile:
+        datafile.seek(start)
+        while length > 0:
+            chunk = datafile.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                raise SnapshotError('{0} is shorter than expected'.format(
+                    path,
+                ))
+            digest.update(chunk)
+            length -= len(chunk)
+    return digest
+
+
+def tail_digest(path, offset):
+    """
+    Returns hex SHA-1 of up to TAIL_SIZE bytes of file preceding offset.
+    """
+    start = max(0, offset - TAIL_SIZE)
+    return file_digest(path, offset - start, start=start).hexdigest()
+
+
+def write_snapshot(path, data, source):
+    """
+    Atomically writes snapshot of PresenceData.
+
+    Source is a dict identifying the CSV file: inode, size, mtime, offset
+    (consumed bytes), sha1 (hex digest of consumed bytes) and tail (see
+    tail_digest).
+    """
+    user_ids = sorted(data)
+    header = dict(
+        source,
+        typecode=TYPECODE,
+        itemsize=array(TYPECODE).itemsize,
+        byteorder=sys.byteorder,
+        users=[[user_id, len(data[user_id])] for user_id in user_ids],
+    )
+    columns = [array(TYPECODE) for _ in range(3)]
+    aggregates = array('d')
+    for user_id in user_ids:
+        user = data[user_id]
+        for column, values in zip(
+                columns, (user.dates, user.starts, user.ends)):
+            column.extend(values)
+        for stats in user.weekdays:
+            aggregates.extend((
+                stats.count, stats.total,
+                stats.start.total, stats.start.m2,
+                stats.end.total, stats.end.m2,
+            ))
+
+    encoded = json.dumps(header)
+    handle, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.snapshot-',
+    )
+    try:
+        with os.fdopen(handle, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+            snapshot.write(encoded)
+            for column in columns:
+                column.tofile(snapshot)
+            aggregates.tofile(snapshot)
+        # mkstemp creates file readable by owner only, snapshot may be
+        # written by cron job and read by web workers
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_snapshot(path):
+    """
+    Returns (header, PresenceData) read from snapshot file.
+
+    Raises SnapshotError if the file is malformed or incompatible.
+    """
+    with open(path, 'rb') as snapshot:
+        try:
+            magic, version, length = HEADER.unpack(
+                snapshot.read(HEADER.size),
+            )
+            header = json.loads(snapshot.read(length))
+        except (struct.error, ValueError):
+            raise SnapshotError('Malformed snapshot {0}'.format(path))
+        if magic != MAGIC or version != FORMAT_VERSION or \
+                header['typecode'] != TYPECODE or \
+                header['itemsize'] != array(TYPECODE).itemsize or \
+                header['byteorder'] != sys.byteorder:
+            raise SnapshotError('Incompatible snapshot {0}'.format(path))
+
+        rows = sum(count for _, count in header['users'])
+        columns = []
+        try:
+            for _ in range(3):
+                column = array(TYPECODE)
+                column.fromfile(snapshot, rows)
+                columns.append(column)
+            aggregates = array('d')
+            aggregates.fromfile(
+                snapshot, len(header['users']) * 7 * AGGREGATES,
+            )
+        except EOFError:
+            raise SnapshotError('Truncated snapshot {0}'.format(path))
+
+    users = {}
+    position = 0
+    values = iter(aggregates)
+    for user_id, rows_count in header['users']:
+        weekdays = []
+        for _ in range(7):
+            count, total, start_total, start_m2, end_total, end_m2 = [
+                next(values) for _ in range(AGGREGATES)
+            ]
+            weekdays.append(WeekdayStats(
+                int(total),
+                RunningStats(int(count), int(start_total), start_m2),
+                RunningStats(int(count), int(end_total), end_m2),
+            ))
+        end = position + rows_count
+        dates, starts, ends = [column[position:end] for column in columns]
+        users[user_id] = UserPresence(dates, starts, ends, weekdays)
+        position = end
+    return header, PresenceData(users)
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Presence statistics aggregated per weekday.
+"""
+import calendar
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from math import sqrt
+
+
+def int64_typecode():
+    """
+    Returns typecode of 64 bit integer arrays: 'q' isn't available before
+    Python 3.3 and 'l' is 32 bit on some platforms. Doubles are the last
+    resort, their integer sums are exact up to 2 ** 53.
+    """
+    for typecode in ('q', 'l'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            continue
+    return 'd'
+
+
+# squared day seconds need more than 32 bits
+SUMS_TYPECODE = int64_typecode()
+
+
+def time_of_day(seconds):
+    """
+    Converts seconds since midnight into [hour, minute, second] list.
+    """
+    time_tuple = time.gmtime(seconds)
+    return [time_tuple.tm_hour, time_tuple.tm_min, time_tuple.tm_sec]
+
+
+def weekday_of(date_ordinal):
+    """
+    Returns weekday (0 is Monday) of date given as proleptic ordinal.
+    """
+    return (date_ordinal + 6) % 7
+
+
+class RunningStats(object):
+    """
+    Streaming accumulator of mean and variance (Welford's algorithm).
+
+    Sum of values is kept as exact integer, so mean is the same as
+    computed directly; sum of squared deviations (m2) is updated
+    incrementally, so variance doesn't suffer from cancellation.
+    Accumulators of separate chunks of data can be merged.
+    """
+    __slots__ = ('count', 'total', 'm2')
+
+    def __init__(self, count=0, total=0, m2=0.0):
+        self.count = count
+        self.total = total
+        self.m2 = m2
+
+    @classmethod
+    def from_sums(cls, count, total, squares):
+        """
+        Creates accumulator from count, sum and sum of squares of integers.
+        """
+        if not count:
+            return cls()
+        return cls(
+            count, total, float(count * squares - total * total) / count,
+        )
+
+    @property
+    def mean(self):
+        """
+        Arithmetic mean. Zero for no values.
+        """
+        return float(self.total) / self.count if self.count else 0
+
+    @property
+    def variance(self):
+        """
+        Population variance. Zero for no values.
+        """
+        return self.m2 / self.count if self.count else 0
+
+    def push(self, value):
+        """
+        Adds single value.
+        """
+        delta = value - self.mean
+        self.count += 1
+        self.total += value
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """
+        Adds values accumulated by other RunningStats.
+        """
+        if not other.count:
+            return
+        if self.count:
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta * delta * (
+                float(self.count) * other.count / (self.count + other.count)
+            )
+        else:
+            self.m2 = other.m2
+        self.count += other.count
+        self.total += other.total
+
+
+class WeekdayStats(object):
+    """
+    Aggregates of presence entries from one weekday.
+
+    Keeps sum of presence intervals and RunningStats of start and end
+    seconds, so means and variances are available without going through
+    the entries again.
+    """
+    __slots__ = ('total', 'start', 'end')
+
+    def __init__(self, total=0, start=None, end=None):
+        self.total = total
+        self.start = start or RunningStats()
+        self.end = end or RunningStats()
+
+    @property
+    def count(self):
+        """
+        Amount of aggregated entries.
+        """
+        return self.start.count
+
+    def add(self, start, end):
+        """
+        Adds single entry given as seconds since midnight.
+        """
+        self.total += end - start
+        self.start.push(start)
+        self.end.push(end)
+
+    def merge(self, other):
+        """
+        Adds aggregates of other WeekdayStats.
+        """
+        self.total += other.total
+        self.start.merge(other.start)
+        self.end.merge(other.end)
+
+    def mean_interval(self):
+        """
+        Mean presence interval in seconds.
+        """
+        return float(self.total) / self.count if self.count else 0
+
+    def mean_start(self):
+        """
+        Mean start of work in seconds since midnight.
+        """
+        return self.start.mean
+
+    def mean_end(self):
+        """
+        Mean end of work in seconds since midnight.
+        """
+        return self.end.mean
+
+    def start_variance(self):
+        """
+        Variance of start of work.
+        """
+        return self.start.variance
+
+    def end_variance(self):
+        """
+        Variance of end of work.
+        """
+        return self.end.variance
+
+
+def weekday_stats(dates, starts, ends):
+    """
+    Aggregates entries given as columns into list of WeekdayStats,
+    one for every day of week.
+    """
+    weekdays = [WeekdayStats() for _ in range(7)]
+    for date, start, end in zip(dates, starts, ends):
+        weekdays[weekday_of(date)].add(start, end)
+    return weekdays
+
+
+def merge_weekday_stats(first, second):
+    """
+    Returns new list of WeekdayStats merged from two others.
+    """
+    weekdays = [WeekdayStats() for _ in range(7)]
+    for merged, one, other in zip(weekdays, first, second):
+        merged.merge(one)
+        merged.merge(other)
+    return weekdays
+
+
+class WeekdayIndex(object):
+    """
+    Entries sorted by weekday and date, with prefix sums of start, end and
+    their squares restarting at every weekday.
+
+    WeekdayStats of any range of dates is then computed with bisection
+    and differences of sums instead of going through the entries. Every
+    column is a single array, but 64 bit sums make the index about three
+    times larger than the entries themselves.
+    """
+    __slots__ = ('dates', 'bounds', 'sums')
+
+    def __init__(self, dates, starts, ends):
+        # sort is stable, so dates of every weekday stay sorted
+        order = sorted(
+            range(len(dates)), key=lambda row: weekday_of(dates[row]),
+        )
+        self.dates = array('i', [dates[row] for row in order])
+        # entries of weekday w are dates[bounds[w]:bounds[w + 1]]
+        self.bounds = [0] * 8
+        for row in order:
+            self.bounds[weekday_of(dates[row]) + 1] += 1
+        for weekday in range(7):
+            self.bounds[weekday + 1] += self.bounds[weekday]
+        # start, start squared, end, end squared; sums of weekday w are
+        # sums[bounds[w] + w:bounds[w + 1] + w + 1], starting with 0
+        columns = [[] for _ in range(4)]
+        for weekday in range(7):
+            totals = [0] * 4
+            for column in columns:
+                column.append(0)
+            for row in order[self.bounds[weekday]:self.bounds[weekday + 1]]:
+                start, end = starts[row], ends[row]
+                for i, value in enumerate(
+                        (start, start * start, end, end * end)):
+                    totals[i] += value
+                    columns[i].append(totals[i])
+        self.sums = [array(SUMS_TYPECODE, column) for column in columns]
+
+    def between(self, first=None, last=None):
+        """
+        Returns list of WeekdayStats of entries from first to last date
+        ordinal inclusive; None means no limit.
+        """
+        weekdays = []
+        for weekday in range(7):
+            low, high = self.bounds[weekday], self.bounds[weekday + 1]
+            if first is not None:
+                low = bisect_left(self.dates, first, low, high)
+            if last is not None:
+                high = bisect_right(self.dates, last, low, high)
+            if high <= low:
+                weekdays.append(WeekdayStats())
+                continue
+            start, start_squares, end, end_squares = [
+                int(column[high + weekday] - column[low + weekday])
+                for column in self.sums
+            ]
+            weekdays.append(WeekdayStats(
+                end - start,
+                RunningStats.from_sums(high - low, start, start_squares),
+                RunningStats.from_sums(high - low, end, end_squares),
+            ))
+        return weekdays
+
+
+def mean_time_weekday(weekdays):
+    """
+    Mean presence time grouped by weekday.
+    """
+    return [
+        (calendar.day_abbr[weekday], stats.mean_interval())
+        for weekday, stats in enumerate(weekdays)
+    ]
+
+
+def presence_weekday(weekdays):
+    """
+    Total presence time grouped by weekday, with header row for the chart.
+    """
+    result = [
+        (calendar.day_abbr[weekday], stats.total)
+        for weekday, stats in enumerate(weekdays)
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(weekdays):
+    """
+    Mean start and end of work grouped by weekday.
+    """
+    return {
+        weekday: {
+            'start': time_of_day(stats.mean_start()),
+            'end': time_of_day(stats.mean_end()),
+        }
+        for weekday, stats in enumerate(weekdays)
+    }
+
+
+def standard_deviation(weekdays):
+    """
+    One standard deviation ranges around mean start and end of work
+    grouped by weekday.
+    """
+    result = {}
+    for weekday, stats in enumerate(weekdays):
+        start_sigma = sqrt(stats.start_variance())
+        end_sigma = sqrt(stats.end_variance())
+        result[weekday] = {
+            'start_variation': [
+                time_of_day(stats.mean_start() - start_sigma),
+                time_of_day(stats.mean_start() + start_sigma),
+            ],
+            'end_variation': [
+                time_of_day(stats.mean_end() - end_sigma),
+                time_of_day(stats.mean_end() + end_sigma),
+            ],
+        }
+    return result
+
+
+METRICS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': presence_start_end,
+    'standard_deviation': standard_deviation,
+}
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, columnar storage of presence data.
+
+Every user is kept as three parallel arrays sorted by date: date ordinals
+and start/end seconds since midnight. Read-only mapping views expose the
+same interface as the old ``{user_id: {date: {'start': .., 'end': ..}}}``
+structure, so existing code keeps working.
+"""
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Mapping
+
+from presence_analyzer.stats import (
+    WeekdayIndex,
+    merge_weekday_stats,
+    weekday_stats,
+)
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+# 32 bit signed integers are enough for date ordinals and day seconds.
+TYPECODE = 'i'
+
+
+def seconds_to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time.
+    """
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return datetime.time(hour, minute, second)
+
+
+class UserPresence(Mapping):
+    """
+    Read-only ``{date: {'start': time, 'end': time}}`` view of user entries.
+
+    Entries are aggregated per weekday when created, see ``weekdays``.
+    WeekdayIndex used for aggregates of date ranges is built on first use
+    and kept as long as the user.
+    """
+
+    def __init__(self, dates, starts, ends, weekdays=None):
+        self.dates = dates
+        self.starts = starts
+        self.ends = ends
+        if weekdays is None:
+            weekdays = weekday_stats(dates, starts, ends)
+        self.weekdays = weekdays
+        self._weekday_index = None
+
+    def weekdays_between(self, first=None, last=None, index=True):
+        """
+        Returns weekday aggregates of entries from first to last date
+        ordinal inclusive; None means no limit.
+
+        Without index, entries of the range are aggregated directly unless
+        the index is already built. Views going once through many users
+        use it, so they don't keep an index of every user.
+        """
+        if first is None and last is None:
+            return self.weekdays
+        if not index and self._weekday_index is None:
+            low = 0 if first is None else bisect_left(self.dates, first)
+            high = len(self.dates) if last is None else \
+                bisect_right(self.dates, last)
+            return weekday_stats(
+                self.dates[low:high],
+                self.starts[low:high],
+                self.ends[low:high],
+            )
+        if self._weekday_index is None:
+            self._weekday_index = WeekdayIndex(
+                self.dates, self.starts, self.ends,
+            )
+        return self._weekday_index.between(first, last)
+
+    def _index(self, date):
+        """
+        Returns position of given date in arrays or raises KeyError.
+        """
+        try:
+            ordinal = date.toordinal()
+        except AttributeError:
+            raise KeyError(date)
+        idx = bisect_left(self.dates, ordinal)
+        if idx == len(self.dates) or self.dates[idx] != ordinal:
+            raise KeyError(date)
+        return idx
+
+    def __getitem__(self, date):
+        idx = self._index(date)
+        return {
+            'start': seconds_to_time(self.starts[idx]),
+            'end': seconds_to_time(self.ends[idx]),
+        }
+
+    def __contains__(self, date):
+        try:
+            self._index(date)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        fromordinal = datetime.date.fromordinal
+        return (fromordinal(ordinal) for ordinal in self.dates)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def iteritems(self):
+        fromordinal = datetime.date.fromordinal
+        for ordinal, start, end in zip(self.dates, self.starts, self.ends):
+            yield fromordinal(ordinal), {
+                'start': seconds_to_time(start),
+                'end': seconds_to_time(end),
+            }
+
+    def items(self):
+        return list(self.iteritems())
+
+    def rows(self):
+        """
+        Iterates over raw ``(date_ordinal, start, end)`` tuples.
+        """
+        return zip(self.dates, self.starts, self.ends)
+
+    def columns(self):
+        """
+        Returns date, start and end columns as NumPy arrays sharing
+        memory with the store, or plain arrays without NumPy.
+        """
+        if numpy is None:
+            return self.dates, self.starts, self.ends
+        return tuple(
+            numpy.frombuffer(column, dtype=numpy.intc)
+            for column in (self.dates, self.starts, self.ends)
+        )
+
+    @property
+    def nbytes(self):
+        """
+        Size of array buffers in bytes.
+        """
+        return sum(
+            column.buffer_info()[1] * column.itemsize
+            for column in (self.dates, self.starts, self.ends)
+        )
+
+    def to_dict(self):
+        """
+        Builds the legacy dict-of-dicts structure.
+        """
+        return dict(self.iteritems())
+
+
+class PresenceData(Mapping):
+    """
+    Read-only ``{user_id: UserPresence}`` mapping.
+
+    Version identifies loaded content, it changes whenever data changes.
+    Modified is modification timestamp of the data source.
+    """
+
+    def __init__(self, users=None, version=None, modified=0):
+        self._users = users if users is not None else {}
+        self.version = version
+        self.modified = modified
+
+    def __getitem__(self, user_id):
+        return self._users[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __iter__(self):
+        return iter(self._users)
+
+    def __len__(self):
+        return len(self._users)
+
+    def keys(self):
+        return self._users.keys()
+
+    @property
+    def rows_count(self):
+        """
+        Total amount of stored presence entries.
+        """
+        return sum(len(user) for user in self._users.itervalues())
+
+    @property
+    def nbytes(self):
+        """
+        Size of all array buffers in bytes.
+        """
+        return sum(user.nbytes for user in self._users.itervalues())
+
+    def to_dict(self):
+        """
+        Builds the legacy ``{user_id: {date: {...}}}`` structure.
+        """
+        return {
+            user_id: user.to_dict()
+            for user_id, user in self._users.iteritems()
+        }
+
+
+def freeze_user(dates, starts, ends):
+    """
+    Creates UserPresence from unsorted columns.
+
+    Entries are sorted by date; when a date repeats the last entry wins,
+    just like consecutive assignments to a dict would.
+    """
+    size = len(dates)
+    if all(dates[i] < dates[i + 1] for i in xrange(size - 1)):
+        return UserPresence(dates, starts, ends)
+    order = sorted(xrange(size), key=dates.__getitem__)
+    new_dates = array(TYPECODE)
+    new_starts = array(TYPECODE)
+    new_ends = array(TYPECODE)
+    for i in order:
+        if new_dates and new_dates[-1] == dates[i]:
+            new_starts[-1] = starts[i]
+            new_ends[-1] = ends[i]
+            continue
+        new_dates.append(dates[i])
+        new_starts.append(starts[i])
+        new_ends.append(ends[i])
+    return UserPresence(new_dates, new_starts, new_ends)
+
+
+def merge_user(user, dates, starts, ends):
+    """
+    Returns UserPresence with new entries merged into existing ones.
+    New entries override existing ones with the same date.
+    """
+    return merge_users(user, freeze_user(dates, starts, ends))
+
+
+def merge_users(user, new):
+    """
+    Returns UserPresence with entries of both given ones. Entries of new
+    override existing ones with the same date.
+    """
+    if not new.dates:
+        return user
+    if not user.dates or user.dates[-1] < new.dates[0]:
+        # appended data is the common case, no need to sort again
+        return UserPresence(
+            user.dates + new.dates,
+            user.starts + new.starts,
+            user.ends + new.ends,
+            merge_weekday_stats(user.weekdays, new.weekdays),
+        )
+    return freeze_user(
+        user.dates + new.dates,
+        user.starts + new.starts,
+        user.ends + new.ends,
+    )
+
+
+class PresenceDataBuilder(object):
+    """
+    Collects presence entries and freezes them into PresenceData.
+    """
+
+    def __init__(self):
+        self.columns = {}
+
+    def add(self, user_id, date_ordinal, start, end):
+        """
+        Adds single presence entry. Start and end are seconds since midnight.
+        """
+        try:
+            dates, starts, ends = self.columns[user_id]
+        except KeyError:
+            dates, starts, ends = self.columns[user_id] = (
+                array(TYPECODE), array(TYPECODE), array(TYPECODE),
+            )
+        dates.append(date_ordinal)
+        starts.append(start)
+        ends.append(end)
+
+    def freeze(self):
+        """
+        Returns ``{user_id: UserPresence}`` dict of collected entries.
+        """
+        return {
+            user_id: freeze_user(*columns)
+            for user_id, columns in self.columns.iteritems()
+        }
+
+    def build(self, base=None, version=None, modified=0):
+        """
+        Returns PresenceData with all collected entries.
+
+        If base PresenceData is given, collected entries are merged into
+        a copy of it. Users without new entries are shared with base.
+        """
+        users = dict(base) if base is not None else {}
+        for user_id, columns in self.columns.iteritems():
+            if user_id in users:
+                users[user_id] = merge_user(users[user_id], *columns)
+            else:
+                users[user_id] = freeze_user(*columns)
+        return PresenceData(users, version, modified)
+
+
+def build_from_parts(parts, base=None, version=None, modified=0):
+    """
+    Returns PresenceData of frozen parts (see PresenceDataBuilder.freeze)
+    merged in order, like PresenceDataBuilder.build does with entries.
+
+    Weekday aggregates of parts are merged, entries are only sorted again
+    if dates of parts overlap.
+    """
+    users = dict(base) if base is not None else {}
+    for part in parts:
+        for user_id, user in part.iteritems():
+            if user_id in users:
+                users[user_id] = merge_users(users[user_id], user)
+            else:
+                users[user_id] = user
+    return PresenceData(users, version, modified)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic presence data used by benchmarks.
+"""
+import datetime
+import random
+import sys
+from xml.sax.saxutils import escape
+
+from presence_analyzer.store import PresenceDataBuilder
+
+DAY = 24 * 3600
+FIRST_DAY = datetime.date(2013, 1, 1)
+NOISE_KINDS = ('fields', 'invalid', 'repeat')
+
+
+def presence_rows(users, days, first_day=FIRST_DAY, seed=0):
+    """
+    Yields (user_id, date_ordinal, start, end) rows for every user and day.
+    """
+    rng = random.Random(seed)
+    first = first_day.toordinal()
+    for user_id in xrange(1, users + 1):
+        for day in xrange(days):
+            start = min(max(int(rng.gauss(9 * 3600, 1800)), 0), DAY - 1)
+            end = min(start + abs(int(rng.gauss(8 * 3600, 3600))), DAY - 1)
+            yield user_id, first + day, start, end
+
+
+def build_data(users, days, seed=0):
+    """
+    Returns PresenceData with synthetic rows.
+    """
+    builder = PresenceDataBuilder()
+    for row in presence_rows(users, days, seed=seed):
+        builder.add(*row)
+    return builder.build(version='synthetic-{0}-{1}-{2}'.format(
+        users, days, seed,
+    ))
+
+
+def clock(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '{0:02d}:{1:02d}:{2:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60,
+    )
+
+
+def noise_line(rng, user_id, ordinal):
+    """
+    Returns CSV line the loader has to deal with: row with wrong amount
+    of fields, invalid time or repeated date overriding previous entry.
+    Second item tells if it's a row loader accepts.
+    """
+    date = datetime.date.fromordinal(ordinal)
+    kind = rng.choice(NOISE_KINDS)
+    if kind == 'fields':
+        return '{0},{1}\n'.format(user_id, date), False
+    if kind == 'invalid':
+        return '{0},{1},25:00:00,26:00:00\n'.format(user_id, date), False
+    start = rng.randint(6 * 3600, 12 * 3600)
+    return '{0},{1},{2},{3}\n'.format(
+        user_id, date, clock(start), clock(start + 8 * 3600),
+    ), True
+
+
+def write_presence_csv(path, users, days, seed=0, noise=0.0):
+    """
+    Writes presence CSV file with synthetic rows. Returns amount of rows
+    the loader accepts.
+
+    Noise is probability of extra noise_line after every row.
+    """
+    rng = random.Random(seed + 1)
+    rows = 0
+    with open(path, 'w') as csvfile:
+        for user_id, ordinal, start, end in presence_rows(
+                users, days, seed=seed):
+            csvfile.write('{0},{1},{2},{3}\n'.format(
+                user_id,
+                datetime.date.fromordinal(ordinal),
+                clock(start),
+                clock(end),
+            ))
+            rows += 1
+            if noise and rng.random() < noise:
+                line, accepted = noise_line(rng, user_id, ordinal)
+                csvfile.write(line)
+                rows += accepted
+    return rows
+
+
+def write_users_xml(path, users, seed=0, noise=0.0):
+    """
+    Writes users XML file with given amount of users.
+
+    Noise is probability of leaving a user out, like users who left
+    the company but still have presence data.
+    """
+    rng = random.Random(seed)
+    with open(path, 'w') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.example.com</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n'
+            '    <users>\n'
+        )
+        for user_id in xrange(1, users + 1):
+            name = '{0} {1}.'.format(
+                ''.join(rng.choice('aeiouklmnprstwz') for _ in range(6)),
+                rng.choice('ABCDEFGHIJKLMNOPRSTWZ'),
+            ).capitalize()
+            if noise and rng.random() < noise:
+                continue
+            xmlfile.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>{1}</name>\n'
+                '        </user>\n'.format(user_id, escape(name))
+            )
+        xmlfile.write('    </users>\n</intranet>\n')
+
+
+def main(argv=None):
+    """
+    Writes presence CSV and users XML files.
+
+    Usage: python -m presence_analyzer.synthetic CSV_PATH XML_PATH USERS
+    DAYS [NOISE [SEED]]
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 4:
+        print main.__doc__.strip()
+        return 2
+    csv_path, xml_path, users, days = argv[:4]
+    noise = float(argv[4]) if len(argv) > 4 else 0.0
+    seed = int(argv[5]) if len(argv) > 5 else 0
+    rows = write_presence_csv(csv_path, int(users), int(days), seed, noise)
+    write_users_xml(xml_path, int(users), seed, noise)
+    print 'Written {0} rows of {1} users'.format(rows, users)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
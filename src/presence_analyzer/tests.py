@@ -4,13 +4,40 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
+import BaseHTTPServer
 import datetime
 import json
+import os
 import os.path
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from collections import defaultdict
+import zlib
+from collections import defaultdict, Mapping
+from StringIO import StringIO
 
-from presence_analyzer import main, utils
+from presence_analyzer import (
+    benchmarks,
+    cron,
+    loadtest,
+    main,
+    metrics,
+    precompute,
+    profiling,
+    snapshot,
+    stats,
+    store,
+    synthetic,
+    users,
+    utils,
+    vectorized,
+    views,
+    warmup,
+)
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
@@ -208,6 +235,349 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(json.loads(resp.data), 'NO_USER_DATA')
         self.assertEqual(resp.status_code, 200)
 
+    def test_batch(self):
+        """
+        Test batch of metrics for many users.
+        """
+        resp = self.client.get(
+            '/api/v1/batch?user_ids=10,11,1000'
+            '&metrics=presence_weekday,standard_deviation'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['10', '11', '1000'])
+        self.assertEqual(data['1000'], 'NO_USER_DATA')
+        for user_id in ('10', '11'):
+            self.assertItemsEqual(
+                data[user_id].keys(),
+                ['presence_weekday', 'standard_deviation'],
+            )
+            for metric in data[user_id]:
+                resp = self.client.get(
+                    '/api/v1/{0}/{1}'.format(metric, user_id),
+                )
+                self.assertEqual(
+                    data[user_id][metric], json.loads(resp.data),
+                )
+
+        resp = self.client.get('/api/v1/batch?user_ids=10')
+        self.assertItemsEqual(
+            json.loads(resp.data)['10'].keys(), stats.METRICS.keys(),
+        )
+
+    def test_batch_bad_request(self):
+        """
+        Test batch with invalid arguments.
+        """
+        for url in [
+                '/api/v1/batch',
+                '/api/v1/batch?user_ids=10,abc',
+                '/api/v1/batch?user_ids=10&metrics=presence_weekday,nope',
+        ]:
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+        main.app.config['BATCH_MAX_USERS'] = 1
+        self.addCleanup(main.app.config.pop, 'BATCH_MAX_USERS')
+        resp = self.client.get('/api/v1/batch?user_ids=10,11')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_summary(self):
+        """
+        Test streamed summary of all users.
+        """
+        main.app.config['SUMMARY_CHUNK_USERS'] = 1
+        self.addCleanup(main.app.config.pop, 'SUMMARY_CHUNK_USERS')
+        resp = self.client.get('/api/v1/summary?metrics=presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        self.assertTrue(resp.is_streamed)
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([line['user_id'] for line in lines], [10, 11])
+        resp = self.client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(lines[1]['presence_weekday'], json.loads(resp.data))
+        self.assertItemsEqual(lines[1].keys(), ['user_id', 'presence_weekday'])
+
+        resp = self.client.get('/api/v1/summary')
+        line = json.loads(resp.data.splitlines()[0])
+        self.assertEqual(len(line), len(stats.METRICS) + 1)
+        resp = self.client.get('/api/v1/summary?metrics=nope')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_conditional_get(self):
+        """
+        Test ETag and Last-Modified validation of API responses.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        self.assertNotEqual(
+            etag,
+            self.client.get('/api/v1/presence_weekday/11').headers['ETag'],
+        )
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'If-None-Match': '"other"'},
+        )
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get(
+            '/api/v2/users',
+            headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Last-Modified'], last_modified)
+        resp = self.client.get(
+            '/api/v2/users',
+            headers={'If-Modified-Since': resp.headers['Last-Modified']},
+        )
+        self.assertEqual(resp.status_code, 304)
+
+        main.app.config['HTTP_CACHE_CONTROL'] = 'max-age=60'
+        self.addCleanup(main.app.config.pop, 'HTTP_CACHE_CONTROL')
+        resp = self.client.get('/api/v1/users')
+        self.assertEqual(resp.headers['Cache-Control'], 'max-age=60')
+
+    def test_conditional_get_skips_view(self):
+        """
+        Test if view isn't called when client's copy is current
+        and ETag changes together with data.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config['DATA_CSV'] = path
+        calls = []
+
+        @utils.jsonify
+        def conditional_view():
+            """
+            Counts calls.
+            """
+            calls.append(1)
+            return len(calls)
+
+        with main.app.test_request_context('/api/v1/test_conditional'):
+            etag = conditional_view().headers['ETag']
+        with main.app.test_request_context(
+                '/api/v1/test_conditional', headers={'If-None-Match': etag}):
+            resp = conditional_view()
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(len(calls), 1)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-16,08:00:00,16:00:00\n')
+        with main.app.test_request_context(
+                '/api/v1/test_conditional', headers={'If-None-Match': etag}):
+            resp = conditional_view()
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(len(calls), 2)
+
+    def test_data_sources_per_view(self):
+        """
+        Test if presence responses don't depend on users XML file.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'users.xml')
+        shutil.copy(USERS_TEST_XML_FILE, path)
+        main.app.config['USERS_XML_FILE'] = path
+        utils.RESPONSE_CACHE.clear()
+        presence = self.client.get('/api/v1/presence_weekday/10')
+        users_etag = self.client.get('/api/v2/users').headers['ETag']
+        self.assertEqual(utils.RESPONSE_CACHE.info()['entries'], 2)
+
+        with open(path, 'a') as xmlfile:
+            xmlfile.write('\n')
+        resp = self.client.get('/api/v2/users')
+        self.assertNotEqual(resp.headers['ETag'], users_etag)
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.headers['ETag'], presence.headers['ETag'])
+        self.assertEqual(utils.RESPONSE_CACHE.info()['entries'], 2)
+
+        os.remove(path)
+        utils.RESPONSE_CACHE.clear()
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, presence.data)
+
+    def test_healthz(self):
+        """
+        Test liveness check.
+        """
+        resp = self.client.get('/healthz')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), {'status': 'ok'})
+
+    def test_warm_up_readiness(self):
+        """
+        Test if worker is ready only after successful warm-up.
+        """
+        self.addCleanup(warmup.STATE.update, dict(warmup.STATE))
+        self.assertEqual(self.client.get('/readyz').status_code, 200)
+
+        warmup.STATE['ready'] = False
+        self.assertEqual(self.client.get('/readyz').status_code, 503)
+
+        utils.TIMESTAMPS['get_users_index'] = 0
+        warmup.start(background=False)
+        resp = self.client.get('/readyz')
+        self.assertEqual(resp.status_code, 200)
+        result = json.loads(resp.data)
+        self.assertTrue(result['ready'])
+        self.assertEqual(
+            sorted(result['warm_up']['steps']),
+            ['presence_data', 'templates', 'users_index'],
+        )
+        self.assertGreaterEqual(
+            result['warm_up']['seconds'],
+            sum(result['warm_up']['steps'].values()),
+        )
+        self.assertIsNone(result['warm_up']['error'])
+        self.assertEqual(warmup.compile_templates(), 5)
+
+        main.app.config['DATA_CSV'] = os.path.join(
+            os.path.dirname(TEST_DATA_CSV), 'missing.csv',
+        )
+        utils.TIMESTAMPS['get_data'] = 0
+        warmup.start(background=True).join(5)
+        resp = self.client.get('/readyz')
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('OSError', json.loads(resp.data)['warm_up']['error'])
+
+    def test_date_range(self):
+        """
+        Test if statistics views are limited to requested dates.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-10&to=2013-09-12',
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data),
+            [
+                ['Weekday', 'Presence (s)'],
+                ['Mon', 0],
+                ['Tue', 16564],
+                ['Wed', 25321],
+                ['Thu', 22969],
+                ['Fri', 0],
+                ['Sat', 0],
+                ['Sun', 0],
+            ],
+        )
+        resp = self.client.get('/api/v1/presence_weekday/11?from=2013-09-13')
+        self.assertEqual(json.loads(resp.data)[5], ['Fri', 6426])
+        self.assertEqual(json.loads(resp.data)[4], ['Thu', 0])
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/11?from=2014-01-01',
+        )
+        self.assertEqual(
+            [value for _, value in json.loads(resp.data)], [0] * 7,
+        )
+        resp = self.client.get(
+            '/api/v1/batch?user_ids=11&metrics=presence_weekday'
+            '&to=2013-09-05',
+        )
+        self.assertEqual(
+            json.loads(resp.data)['11']['presence_weekday'][4],
+            ['Thu', 22999],
+        )
+
+    def test_date_range_invalid(self):
+        """
+        Test if malformed dates are rejected.
+        """
+        for url in ('/api/v1/presence_weekday/11?from=2013-13-01',
+                    '/api/v1/standard_deviation/11?to=yesterday',
+                    '/api/v1/summary?from=2013/09/10'):
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+
+    def test_response_cache(self):
+        """
+        Test if encoded responses are reused and dropped with old data.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config['DATA_CSV'] = path
+        utils.RESPONSE_CACHE.clear()
+        calls = []
+
+        @utils.jsonify
+        def cached_view(number):
+            """
+            Counts calls.
+            """
+            calls.append(number)
+            return number
+
+        def get(number):
+            """
+            Calls view in context of request to its URL.
+            """
+            with main.app.test_request_context(
+                    '/api/v1/test_response_cache/{0}'.format(number)):
+                return cached_view(number)
+
+        self.assertEqual(get(1).data, '1')
+        get(2)
+        self.assertEqual(get(1).data, '1')
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(utils.RESPONSE_CACHE.info()['entries'], 2)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-16,08:00:00,16:00:00\n')
+        get(1)
+        self.assertEqual(calls, [1, 2, 1])
+        self.assertEqual(utils.RESPONSE_CACHE.info()['entries'], 1)
+
+    def test_response_cache_gzip(self):
+        """
+        Test if gzipped response is sent to clients accepting it.
+        """
+        utils.RESPONSE_CACHE.clear()
+        main.app.config.update(
+            {'RESPONSE_GZIP': True, 'RESPONSE_GZIP_MIN_SIZE': 0},
+        )
+        self.addCleanup(main.app.config.pop, 'RESPONSE_GZIP')
+        self.addCleanup(main.app.config.pop, 'RESPONSE_GZIP_MIN_SIZE')
+        plain = self.client.get('/api/v1/presence_start_end/11')
+        self.assertIsNone(plain.content_encoding)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        resp = self.client.get(
+            '/api/v1/presence_start_end/11',
+            headers={'Accept-Encoding': 'gzip'},
+        )
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), plain.data,
+        )
+
+        # variants have different validators, 304 keeps the matching one
+        self.assertEqual(resp.headers['ETag'], plain.headers['ETag'][:-1] +
+                         utils.GZIP_ETAG_SUFFIX + '"')
+        for etag in (plain.headers['ETag'], resp.headers['ETag']):
+            not_modified = self.client.get(
+                '/api/v1/presence_start_end/11',
+                headers={'If-None-Match': etag},
+            )
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.headers['ETag'], etag)
+            self.assertIn('Accept-Encoding', not_modified.headers['Vary'])
+
     def test_render_html(self):
         """
         Test if function operate template rendering correctly.
@@ -251,7 +621,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, Mapping)
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
@@ -351,11 +721,184 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
                 'end': datetime.time(16, 7, 37),
             },
         }
-        self.assertDictEqual(expected_data, utils.get_data()[10])
+        self.assertDictEqual(expected_data, dict(utils.get_data()[10]))
         utils.CACHE = {'get_data': {10: 'rubbish'}}
         self.assertNotEqual(expected_data, utils.get_data()[10])
         utils.TIMESTAMPS['get_data'] = 0
-        self.assertDictEqual(expected_data, utils.get_data()[10])
+        self.assertDictEqual(expected_data, dict(utils.get_data()[10]))
+
+    def test_memorize_watches_files(self):
+        """
+        Test if change of watched file invalidates cached data.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'watched.txt')
+        main.app.config['WATCHED_FILE'] = path
+        calls = []
+
+        @utils.memorize(600, watch=('WATCHED_FILE',))
+        def watched():
+            """
+            Counts calls.
+            """
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(watched(), 1)
+        self.assertEqual(watched(), 1)
+        with open(path, 'w') as watched_file:
+            watched_file.write('changed')
+        self.assertEqual(watched(), 2)
+        self.assertEqual(watched(), 2)
+        self.assertEqual(watched.__name__, 'watched')
+
+    def test_memorize_stale_while_revalidate(self):
+        """
+        Test if expired data is returned while it's rebuilt in background.
+        """
+        main.app.config['CACHE_STALE_WHILE_REVALIDATE'] = True
+        self.addCleanup(
+            main.app.config.pop, 'CACHE_STALE_WHILE_REVALIDATE',
+        )
+        calls = []
+
+        @utils.memorize(600)
+        def slow():
+            """
+            Counts calls.
+            """
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(slow(), 1)
+        utils.TIMESTAMPS['slow'] = 0
+        self.assertEqual(slow(), 1)
+        for _ in range(100):
+            if utils.CACHE['slow'] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(slow(), 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_lru_memorize(self):
+        """
+        Test argument keyed memorizing with LRU eviction and statistics.
+        """
+        calls = []
+        version = ['v1']
+
+        @utils.lru_memorize(max_entries=2, version=lambda: version[0])
+        def square(number):
+            """
+            Counts calls.
+            """
+            calls.append(number)
+            return number * number
+
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(calls, [2, 3])
+        square(2)
+        square(4)  # evicts 3, the least recently used
+        square(3)
+        self.assertEqual(calls, [2, 3, 4, 3])
+        version[0] = 'v2'
+        square(3)
+        self.assertEqual(calls, [2, 3, 4, 3, 3])
+
+        info = square.cache_info()
+        self.assertEqual(info['hits'], 2)
+        self.assertEqual(info['misses'], 5)
+        self.assertEqual(info['evictions'], 3)
+        self.assertEqual(info['entries'], 2)
+        self.assertGreater(info['bytes'], 0)
+        self.assertEqual(info['rebuilds'], 5)
+        self.assertIn('square', utils.lru_cache_stats())
+
+        square.cache_clear()
+        self.assertEqual(square.cache_info()['entries'], 0)
+
+    def test_lru_memorize_byte_budget(self):
+        """
+        Test if cache size is bounded by byte budget.
+        """
+        @utils.lru_memorize(max_bytes=utils.deep_sizeof(range(100)) * 2)
+        def numbers(count):
+            """
+            Returns list of numbers.
+            """
+            return range(count)
+
+        numbers(100)
+        numbers(101)
+        numbers(10000)
+        info = numbers.cache_info()
+        self.assertEqual(info['entries'], 1)
+        self.assertEqual(info['evictions'], 1)
+        self.assertLessEqual(info['bytes'], utils.deep_sizeof(range(100)) * 2)
+
+    def test_lru_memorize_per_key_locks(self):
+        """
+        Test if computing one key doesn't block other keys.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        @utils.lru_memorize()
+        def blocking(key):
+            """
+            Blocks for key 'slow'.
+            """
+            if key == 'slow':
+                started.set()
+                release.wait(5)
+            return key
+
+        thread = threading.Thread(target=blocking, args=('slow',))
+        thread.start()
+        started.wait(5)
+        self.assertEqual(blocking('fast'), 'fast')
+        self.assertTrue(thread.is_alive())
+        release.set()
+        thread.join(5)
+        self.assertEqual(blocking.cache_info()['entries'], 2)
+        self.assertEqual(blocking.key_locks, {})
+
+    def test_lru_memorize_error(self):
+        """
+        Test if failing call isn't cached and releases its key lock.
+        """
+        calls = []
+
+        @utils.lru_memorize()
+        def failing(key):
+            """
+            Fails on first call.
+            """
+            calls.append(key)
+            if len(calls) == 1:
+                raise IOError('failed')
+            return key
+
+        self.assertRaises(IOError, failing, 1)
+        self.assertEqual(failing.key_locks, {})
+        self.assertEqual(failing(1), 1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_views_are_memorized_per_user(self):
+        """
+        Test if user views results are cached per user and data version.
+        """
+        client = main.app.test_client()
+        utils.RESPONSE_CACHE.clear()
+        views.presence_weekday_view.cache_clear()
+        client.get('/api/v1/presence_weekday/10')
+        client.get('/api/v1/presence_weekday/11')
+        client.get('/api/v1/presence_weekday/10')
+        info = utils.LRU_CACHES['presence_weekday_view'].info()
+        self.assertEqual(info['entries'], 2)
 
     def test_mean_start_end_for_sv(self):
         """
@@ -439,6 +982,1490 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         )
 
 
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.TIMESTAMPS['get_data'] = 0
+
+    def test_builder_sorts_and_overrides(self):
+        """
+        Test if entries are sorted by date and repeated date keeps last one.
+        """
+        builder = store.PresenceDataBuilder()
+        builder.add(1, 735000, 10, 20)
+        builder.add(1, 734000, 30, 40)
+        builder.add(1, 735000, 50, 60)
+        data = builder.build()
+        self.assertEqual(list(data[1].dates), [734000, 735000])
+        self.assertEqual(list(data[1].starts), [30, 50])
+        self.assertEqual(list(data[1].ends), [40, 60])
+
+    def test_user_presence_mapping(self):
+        """
+        Test read-only mapping interface of user entries.
+        """
+        user = utils.get_data()[10]
+        self.assertEqual(len(user), 3)
+        self.assertEqual(
+            list(user),
+            [
+                datetime.date(2013, 9, 10),
+                datetime.date(2013, 9, 11),
+                datetime.date(2013, 9, 12),
+            ],
+        )
+        self.assertNotIn(datetime.date(2013, 9, 9), user)
+        self.assertNotIn('2013-09-10', user)
+        # pylint: disable=pointless-statement
+        with self.assertRaises(KeyError):
+            user[datetime.date(2013, 9, 13)]
+        self.assertEqual(
+            user[datetime.date(2013, 9, 12)]['end'],
+            datetime.time(17, 23, 51),
+        )
+        self.assertEqual(dict(user), user.to_dict())
+
+    def test_seconds_to_time(self):
+        """
+        Test conversion of seconds since midnight to time.
+        """
+        self.assertEqual(store.seconds_to_time(0), datetime.time(0, 0, 0))
+        self.assertEqual(
+            store.seconds_to_time(64792),
+            datetime.time(17, 59, 52),
+        )
+
+    def test_fast_parse_line(self):
+        """
+        Test parsing of lines matching the fixed CSV layout.
+        """
+        dates, times = {}, {}
+        self.assertEqual(
+            utils.fast_parse_line('10,2013-09-10,09:39:05,17:59:52\r\n',
+                                  dates, times),
+            (10, 735121, 34745, 64792),
+        )
+        self.assertEqual(dates, {'2013-09-10': 735121})
+        for line in [
+                'user_id,date,start,end\n',
+                '10,2013-09-10,9:39:05,17:59:52\n',
+                '10,2013-02-30,09:39:05,17:59:52\n',
+                '10,2013-09-10,09:39:05,24:00:00\n',
+                'x,2013-09-10,09:39:05,17:59:52\n',
+                '10,2013-09-10, 9:39:05,17:59:52\n',
+                '10,2013-09-10,+9:39:05,17:59:52\n',
+                '10,2013-09-10,09:39:05,17:59:-2\n',
+                '10,+013-09-16,09:39:05,17:59:52\n',
+                '10,2013- 9-16,09:39:05,17:59:52\n',
+                '\n',
+        ]:
+            self.assertIsNone(utils.fast_parse_line(line, {}, {}), line)
+
+    def test_fast_parser_is_not_looser(self):
+        """
+        Test if fast parser accepts the same edge case rows as strptime.
+        """
+        lines = [
+            '10,2013-09-10, 9:00:00,17:00:00\n',
+            '10,2013-09-11,+9:00:00,17:00:00\n',
+            '10,+013-09-16,09:00:00,17:00:00\n',
+            '10,2013-+9-12,09:00:00,17:00:00\n',
+            '10,2013-09-13,09:00:00,17:0 :00\n',
+            '10,2013-09-14,9:00:00,17:00:00\n',
+            ' 10,2013-09-15,09:00:00,17:00:00\n',
+            '10,2013-09-16,09:00:00,17:00:00\n',
+        ]
+        results = []
+        for fast in (True, False):
+            builder = store.PresenceDataBuilder()
+            parse_stats = utils.parse_presence_lines(lines, builder, fast=fast)
+            data = builder.build()
+            results.append((parse_stats['rows'], list(data[10].dates)))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0], 3)
+
+    def test_parse_presence_lines_fallback(self):
+        """
+        Test if lines not matching the layout go through strict parser.
+        """
+        lines = [
+            'presence export,2013-09-13\n',
+            '10,2013-09-10,09:39:05,17:59:52\n',
+            '10,2013-09-11,9:19:52,16:07:37\n',
+            '"11",2013-09-05,09:28:08,15:51:27\n',
+            '11,2013-09-06,09:28:08,25:51:27\n',
+        ]
+        for fast in (True, False):
+            builder = store.PresenceDataBuilder()
+            parse_stats = utils.parse_presence_lines(lines, builder, fast=fast)
+            self.assertEqual(parse_stats['rows'], 3)
+            self.assertEqual(parse_stats['skipped'], 1)
+            self.assertEqual(parse_stats['invalid'], 1)
+            self.assertGreater(parse_stats['rows_per_second'], 0)
+            data = builder.build()
+            self.assertEqual(list(data[10].starts), [34745, 33592])
+            self.assertEqual(list(data[11].ends), [57087])
+        self.assertEqual(parse_stats['slow'], 5)
+
+    def test_merge_user(self):
+        """
+        Test merging of new entries into existing user data.
+        """
+        builder = store.PresenceDataBuilder()
+        builder.add(1, 10, 1, 2)
+        builder.add(1, 20, 3, 4)
+        builder.add(2, 10, 5, 6)
+        base = builder.build()
+        builder = store.PresenceDataBuilder()
+        builder.add(1, 15, 7, 8)
+        builder.add(1, 20, 9, 10)
+        builder.add(3, 30, 11, 12)
+        data = builder.build(base=base)
+        self.assertEqual(list(data[1].dates), [10, 15, 20])
+        self.assertEqual(list(data[1].starts), [1, 7, 9])
+        self.assertIs(data[2], base[2])
+        self.assertEqual(list(data[3].dates), [30])
+        self.assertEqual(list(base[1].dates), [10, 20])
+
+    def test_memory_benchmark(self):
+        """
+        Test if columnar store is reported smaller than legacy structure.
+        """
+        result = benchmarks.bench_memory(benchmarks.SAMPLE_DATA_CSV)
+        self.assertEqual(result['rows'], 15188)
+        self.assertEqual(result['users'], 103)
+        self.assertLess(result['store_bytes'], result['legacy_bytes'])
+        self.assertLess(result['index_bytes'], result['store_bytes'])
+
+
+class PresenceAnalyzerLoaderTestCase(unittest.TestCase):
+    """
+    Incremental loading of presence CSV tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.loader = utils.PresenceLoader()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def append(self, text):
+        """
+        Appends text to the presence file.
+        """
+        with open(self.path, 'ab') as csvfile:
+            csvfile.write(text)
+
+    def test_parses_only_appended_lines(self):
+        """
+        Test if appended rows are parsed and merged into previous data.
+        """
+        data = self.loader.load(self.path)
+        self.assertEqual(data.rows_count, 9)
+        self.assertIs(self.loader.load(self.path), data)
+
+        # last line of test data has no newline, so it's parsed again
+        self.append('\r\n12,2013-09-16,08:00:00,16:00:00\r\n')
+        new_data = self.loader.load(self.path)
+        self.assertEqual(self.loader.last_stats['rows'], 2)
+        self.assertEqual(new_data.rows_count, 10)
+        self.assertIs(new_data[10], data[10])
+        self.assertEqual(
+            new_data[12][datetime.date(2013, 9, 16)]['end'],
+            datetime.time(16, 0, 0),
+        )
+        self.assertEqual(self.loader.offset, os.path.getsize(self.path))
+
+    def test_partial_line_is_parsed_again(self):
+        """
+        Test if unfinished trailing line is fixed on next load.
+        """
+        self.append('\r\n12,2013-09-16,08:00:00,16:00:0')
+        data = self.loader.load(self.path)
+        self.assertEqual(
+            data[12][datetime.date(2013, 9, 16)]['end'],
+            datetime.time(16, 0, 0),
+        )
+        self.append('7\n')
+        data = self.loader.load(self.path)
+        self.assertEqual(self.loader.last_stats['rows'], 1)
+        self.assertEqual(
+            data[12][datetime.date(2013, 9, 16)]['end'],
+            datetime.time(16, 0, 7),
+        )
+
+    def test_full_reload(self):
+        """
+        Test if truncated or replaced file is loaded from scratch.
+        """
+        self.loader.load(self.path)
+        with open(self.path, 'wb') as csvfile:
+            csvfile.write('13,2013-09-16,08:00:00,16:00:00\n')
+        data = self.loader.load(self.path)
+        self.assertItemsEqual(data.keys(), [13])
+
+        replacement = os.path.join(self.tmpdir, 'new.csv')
+        shutil.copy(TEST_DATA_CSV, replacement)
+        os.rename(replacement, self.path)
+        data = self.loader.load(self.path)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(self.loader.last_stats['rows'], 9)
+
+    def test_reload_rewritten_in_place(self):
+        """
+        Test if file rewritten to larger size keeping inode isn't appended.
+        """
+        self.loader.load(self.path)
+        with open(self.path, 'rb') as csvfile:
+            content = csvfile.read()
+        inode = os.stat(self.path).st_ino
+        with open(self.path, 'wb') as csvfile:
+            # user ids 10 and 11 become 20 and 21
+            csvfile.write('\n'.join(
+                '2' + line[1:] for line in content.splitlines()
+            ))
+            csvfile.write('\n22,2013-09-16,08:00:00,16:00:00\n')
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        data = self.loader.load(self.path)
+        self.assertItemsEqual(data.keys(), [20, 21, 22])
+        self.assertEqual(self.loader.last_stats['rows'], 10)
+
+    def assert_same_data(self, data, expected):
+        """
+        Checks if data has the same entries and aggregates as expected.
+        """
+        self.assertItemsEqual(data.keys(), expected.keys())
+        for user_id, user in expected.iteritems():
+            self.assertEqual(data[user_id].rows(), user.rows())
+            for name, metric in stats.METRICS.iteritems():
+                self.assertEqual(
+                    metric(data[user_id].weekdays), metric(user.weekdays),
+                    (user_id, name),
+                )
+
+    def test_snapshot_round_trip(self):
+        """
+        Test if snapshot is read back with the same data.
+        """
+        path = os.path.join(self.tmpdir, 'data.snapshot')
+        data = synthetic.build_data(20, 30)
+        source = {'size': 1, 'mtime': 2.5, 'offset': 1, 'sha1': 'abc'}
+        snapshot.write_snapshot(path, data, source)
+        header, restored = snapshot.read_snapshot(path)
+        self.assertEqual(header['sha1'], 'abc')
+        self.assert_same_data(restored, data)
+
+        with open(path, 'r+b') as snapshot_file:
+            snapshot_file.truncate(os.path.getsize(path) - 8)
+        self.assertRaises(
+            snapshot.SnapshotError, snapshot.read_snapshot, path,
+        )
+        with open(path, 'wb') as snapshot_file:
+            snapshot_file.write('garbage')
+        self.assertRaises(
+            snapshot.SnapshotError, snapshot.read_snapshot, path,
+        )
+
+    def test_loads_from_snapshot(self):
+        """
+        Test if new loader starts from snapshot and parses only the rest.
+        """
+        path = os.path.join(self.tmpdir, 'data.snapshot')
+        self.append('\n')
+        data = self.loader.load(self.path, path)
+        self.assertTrue(os.path.exists(path))
+
+        # unchanged file isn't hashed
+        hashed = []
+
+        def file_digest(*args, **kwargs):
+            """
+            Records hashing.
+            """
+            hashed.append(args)
+            return snapshot.file_digest(*args, **kwargs)
+
+        utils.file_digest = file_digest
+        self.addCleanup(setattr, utils, 'file_digest', snapshot.file_digest)
+        loader = utils.PresenceLoader()
+        self.assert_same_data(loader.load(self.path, path), data)
+        self.assertEqual(loader.last_stats['rows'], 0)
+        self.assertEqual(hashed, [])
+
+        self.append('12,2013-09-16,08:00:00,16:00:00\n')
+        loader = utils.PresenceLoader()
+        new_data = loader.load(self.path, path)
+        self.assertEqual(loader.last_stats['rows'], 1)
+        self.assertEqual(new_data.rows_count, 10)
+        self.assertEqual(
+            loader.digest.hexdigest(),
+            snapshot.file_digest(self.path, loader.offset).hexdigest(),
+        )
+
+    def test_precompute(self):
+        """
+        Test if precomputed snapshot is only read by loader.
+        """
+        path = os.path.join(self.tmpdir, 'data.snapshot')
+        self.append('\n')
+        loader = utils.PresenceLoader()
+        loader.load(self.path, path, save=False)
+        self.assertFalse(os.path.exists(path))
+
+        config = os.path.join(self.tmpdir, 'deploy.cfg')
+        with open(config, 'w') as config_file:
+            config_file.write('DATA_CSV = {0!r}\n'.format(str(self.path)))
+        self.addCleanup(main.app.config.update,
+                        DATA_CSV=main.app.config['DATA_CSV'])
+        stdout, sys.stdout = sys.stdout, StringIO()
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+        self.assertEqual(precompute.main([config]), 1)
+        with open(config, 'a') as config_file:
+            config_file.write('DATA_SNAPSHOT = {0!r}\n'.format(str(path)))
+        self.addCleanup(main.app.config.pop, 'DATA_SNAPSHOT')
+        self.assertEqual(precompute.main([config]), 0)
+        self.assertIn('has 9 rows of 2 users', sys.stdout.getvalue())
+        self.assertEqual(oct(os.stat(path).st_mode & 0o777), '0644')
+        modified = os.path.getmtime(path)
+
+        self.append('12,2013-09-16,08:00:00,16:00:00\n')
+        loader = utils.PresenceLoader()
+        self.assertEqual(loader.load(self.path, path, save=False).rows_count,
+                         10)
+        self.assertEqual(loader.last_stats['rows'], 1)
+        self.assertEqual(os.path.getmtime(path), modified)
+
+        self.assertEqual(precompute.precompute(self.path, path).offset,
+                         loader.offset)
+        loader = utils.PresenceLoader()
+        loader.load(self.path, path, save=False)
+        self.assertEqual(loader.last_stats['rows'], 0)
+
+    def test_snapshot_written_after_full_load(self):
+        """
+        Test if incremental loads don't rewrite snapshot.
+        """
+        path = os.path.join(self.tmpdir, 'data.snapshot')
+        self.append('\n')
+        self.loader.load(self.path, path)
+        header, _ = snapshot.read_snapshot(path)
+        self.append('12,2013-09-16,08:00:00,16:00:00\n')
+        self.assertEqual(self.loader.load(self.path, path).rows_count, 10)
+        self.assertEqual(snapshot.read_snapshot(path)[0], header)
+
+        # rewritten file is loaded from scratch, so snapshot is written
+        with open(self.path, 'wb') as csvfile:
+            csvfile.write('13,2013-09-16,08:00:00,16:00:00\n' * 20)
+        self.loader.load(self.path, path)
+        self.assertEqual(
+            snapshot.read_snapshot(path)[0]['offset'], self.loader.offset,
+        )
+
+    def test_snapshot_of_rewritten_file(self):
+        """
+        Test if snapshot with different last consumed bytes is ignored even
+        if inode, size and mtime match.
+        """
+        path = os.path.join(self.tmpdir, 'data.snapshot')
+        self.append('\n')
+        data = self.loader.load(self.path, path)
+        header, _ = snapshot.read_snapshot(path)
+        snapshot.write_snapshot(path, data, dict(header, tail='0' * 40))
+        loader = utils.PresenceLoader()
+        loader.load(self.path, path)
+        self.assertEqual(loader.last_stats['rows'], 9)
+        self.assertEqual(
+            snapshot.read_snapshot(path)[0]['tail'], header['tail'],
+        )
+
+    def test_stale_snapshot(self):
+        """
+        Test if snapshot of different content is ignored and rewritten.
+        """
+        path = os.path.join(self.tmpdir, 'data.snapshot')
+        self.loader.load(self.path, path)
+        with open(self.path, 'r+b') as csvfile:
+            csvfile.write('12')
+        loader = utils.PresenceLoader()
+        data = loader.load(self.path, path)
+        self.assertEqual(loader.last_stats['rows'], 9)
+        self.assertItemsEqual(data.keys(), [10, 11, 12])
+        header, _ = snapshot.read_snapshot(path)
+        self.assertEqual(header['offset'], loader.offset)
+
+    def test_split_ranges(self):
+        """
+        Test if byte ranges cover the file and start at line boundaries.
+        """
+        with open(self.path, 'rb') as csvfile:
+            content = csvfile.read()
+        for parts in (1, 2, 3, 4, 20):
+            ranges = utils.split_ranges(self.path, 10, len(content), parts)
+            self.assertLessEqual(len(ranges), parts)
+            self.assertEqual(ranges[0][0], 10)
+            self.assertEqual(ranges[-1][1], len(content))
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, start)
+                self.assertEqual(content[start - 1], '\n')
+
+    def test_parallel_same_as_serial(self):
+        """
+        Test if parallel loading gives the same data as serial one.
+        """
+        synthetic.write_presence_csv(self.path, 30, 40)
+        # header, invalid row, repeated date and unfinished line
+        with open(self.path, 'r+b') as csvfile:
+            content = csvfile.read()
+            csvfile.seek(0)
+            csvfile.write('user_id,date\n' + content)
+        self.append(
+            '5,2013-01-03,25:00:00,26:00:00\n'
+            '5,2013-01-03,07:00:00,15:00:00\n'
+            '31,2013-01-03,07:00:00,15:0'
+        )
+        serial = self.loader.load(self.path)
+        original = utils.PARALLEL_MIN_BYTES
+        utils.PARALLEL_MIN_BYTES = 0
+        self.addCleanup(setattr, utils, 'PARALLEL_MIN_BYTES', original)
+        for workers in (2, 3, 4):
+            loader = utils.PresenceLoader()
+            data = loader.load(self.path, workers=workers)
+            self.assertEqual(loader.last_stats['workers'], workers)
+            for key in ('rows', 'skipped', 'invalid'):
+                self.assertEqual(
+                    loader.last_stats[key], self.loader.last_stats[key],
+                )
+            self.assertEqual(loader.offset, self.loader.offset)
+            self.assertEqual(
+                loader.digest.hexdigest(), self.loader.digest.hexdigest(),
+            )
+            self.assert_same_data(data, serial)
+        self.assertEqual(
+            serial[5][datetime.date(2013, 1, 3)]['start'],
+            datetime.time(7, 0, 0),
+        )
+
+    def test_get_data_parses_serially(self):
+        """
+        Test if request path never forks pool of parsing processes.
+        """
+        original = utils.PARALLEL_MIN_BYTES
+        utils.PARALLEL_MIN_BYTES = 0
+        self.addCleanup(setattr, utils, 'PARALLEL_MIN_BYTES', original)
+        main.app.config.update({'DATA_CSV': self.path, 'INGEST_WORKERS': 4})
+        self.addCleanup(main.app.config.pop, 'INGEST_WORKERS')
+        self.addCleanup(main.app.config.update, {'DATA_CSV': TEST_DATA_CSV})
+        utils.get_data()
+        self.assertNotIn('workers', utils.LOADER.last_stats)
+
+
+class PresenceAnalyzerStatsTestCase(unittest.TestCase):
+    """
+    Weekday aggregates tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.TIMESTAMPS['get_data'] = 0
+
+    def test_weekday_of(self):
+        """
+        Test weekday computed from date ordinal.
+        """
+        for day in range(1, 15):
+            date = datetime.date(2013, 9, day)
+            self.assertEqual(stats.weekday_of(date.toordinal()),
+                             date.weekday())
+
+    def test_running_stats(self):
+        """
+        Test streaming mean and variance against two pass computation.
+        """
+        values = [34088, 37116, 33134, 35990, 40012, 31999]
+        running = stats.RunningStats()
+        for value in values:
+            running.push(value)
+        mean = float(sum(values)) / len(values)
+        variance = sum((value - mean) ** 2 for value in values) / len(values)
+        self.assertEqual(running.count, 6)
+        self.assertEqual(running.mean, mean)
+        self.assertAlmostEqual(running.variance, variance)
+        self.assertAlmostEqual(
+            stats.RunningStats.from_sums(
+                len(values), sum(values), sum(value ** 2 for value in values),
+            ).variance,
+            variance,
+        )
+        self.assertEqual(stats.RunningStats().mean, 0)
+        self.assertEqual(stats.RunningStats().variance, 0)
+
+    def test_running_stats_merge(self):
+        """
+        Test if merged chunks give the same result as single pass.
+        """
+        values = [34088, 37116, 33134, 35990, 40012, 31999, 36000]
+        whole = stats.RunningStats()
+        for value in values:
+            whole.push(value)
+        merged = stats.RunningStats()
+        for chunk in (values[:3], [], values[3:5], values[5:]):
+            part = stats.RunningStats()
+            for value in chunk:
+                part.push(value)
+            merged.merge(part)
+        self.assertEqual(merged.count, whole.count)
+        self.assertEqual(merged.total, whole.total)
+        self.assertAlmostEqual(merged.variance, whole.variance)
+
+    def test_weekdays_index(self):
+        """
+        Test if aggregates are built together with user data.
+        """
+        weekdays = utils.get_data()[11].weekdays
+        self.assertEqual(len(weekdays), 7)
+        thursday = weekdays[3]
+        self.assertEqual(thursday.count, 2)
+        self.assertEqual(thursday.total, 22999 + 22969)
+        self.assertEqual(thursday.mean_start(), 35602.0)
+        self.assertEqual(thursday.start_variance(), 2292196.0)
+        self.assertEqual(thursday.end_variance(), 2247001.0)
+        self.assertEqual(weekdays[5].count, 0)
+        self.assertEqual(weekdays[5].mean_interval(), 0)
+        self.assertEqual(weekdays[5].start_variance(), 0)
+
+    def test_merged_weekdays_index(self):
+        """
+        Test if aggregates of appended entries are merged.
+        """
+        user = utils.get_data()[11]
+        builder = store.PresenceDataBuilder()
+        builder.add(11, datetime.date(2013, 9, 19).toordinal(), 100, 200)
+        merged = builder.build(base=utils.get_data())[11]
+        self.assertEqual(merged.weekdays[3].count, 3)
+        self.assertEqual(
+            merged.weekdays[3].total,
+            user.weekdays[3].total + 100,
+        )
+        self.assertEqual(user.weekdays[3].count, 2)
+
+    def test_weekdays_between(self):
+        """
+        Test if aggregates of date ranges equal aggregates of entries
+        from these dates.
+        """
+        user = synthetic.build_data(1, 60)[1]
+        unindexed = store.UserPresence(user.dates, user.starts, user.ends)
+        rows = user.rows()
+        first_day = synthetic.FIRST_DAY.toordinal()
+        ranges = [
+            (None, None),
+            (None, first_day + 10),
+            (first_day + 5, None),
+            (first_day + 7, first_day + 40),
+            (first_day + 3, first_day + 3),
+            (first_day + 9, first_day + 2),
+        ]
+        for first, last in ranges:
+            selected = [
+                row for row in rows
+                if (first is None or row[0] >= first) and
+                (last is None or row[0] <= last)
+            ]
+            expected = stats.weekday_stats(*zip(*selected) or ([], [], []))
+            result = user.weekdays_between(first, last)
+            result += unindexed.weekdays_between(first, last, index=False)
+            for weekday, (one, other) in enumerate(zip(result, expected * 2)):
+                self.assertEqual(one.count, other.count, weekday)
+                self.assertEqual(one.total, other.total, weekday)
+                self.assertEqual(one.mean_start(), other.mean_start())
+                self.assertEqual(one.mean_end(), other.mean_end())
+                self.assertAlmostEqual(
+                    one.start_variance(), other.start_variance(), 4,
+                )
+                self.assertAlmostEqual(
+                    one.end_variance(), other.end_variance(), 4,
+                )
+        self.assertIs(user.weekdays_between(), user.weekdays)
+        # pylint: disable=protected-access
+        self.assertIsNone(unindexed._weekday_index)
+
+
+class PresenceAnalyzerVectorizedTestCase(unittest.TestCase):
+    """
+    All users statistics engine tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.TIMESTAMPS['get_data'] = 0
+
+    def assert_same_as_per_user(self, data):
+        """
+        Checks if all users statistics equal per user ones.
+        """
+        result = vectorized.all_users_stats(data)
+        self.assertItemsEqual(result.keys(), data.keys())
+        for user_id, user in data.iteritems():
+            for name, metric in stats.METRICS.iteritems():
+                self.assertEqual(
+                    result[user_id][name],
+                    metric(user.weekdays),
+                    (user_id, name),
+                )
+
+    def test_same_as_per_user(self):
+        """
+        Test if results are identical to per user functions.
+        """
+        self.assert_same_as_per_user(utils.get_data())
+        self.assert_same_as_per_user(synthetic.build_data(50, 30))
+        self.assert_same_as_per_user(store.PresenceData())
+
+    def test_selected_metrics(self):
+        """
+        Test if only requested metrics are computed.
+        """
+        result = vectorized.all_users_stats(
+            utils.get_data(), ['presence_weekday'],
+        )
+        self.assertEqual(result[10].keys(), ['presence_weekday'])
+
+    def test_without_numpy(self):
+        """
+        Test fallback to per user computation.
+        """
+        numpy = vectorized.numpy
+        vectorized.numpy = None
+        try:
+            self.assert_same_as_per_user(utils.get_data())
+        finally:
+            vectorized.numpy = numpy
+
+
+USERS_XML = """<?xml version="1.0" encoding="UTF-8" ?>
+<intranet>
+    <server>
+        <host>intranet.stxnext.pl</host>
+        <protocol>https</protocol>
+    </server>
+    <users>
+        {0}
+    </users>
+</intranet>
+"""
+
+
+def users_xml(*names):
+    """
+    Returns users XML with users of given names.
+    """
+    return USERS_XML.format(''.join(
+        '<user id="{0}"><avatar>/api/images/users/{0}</avatar>'
+        '<name>{1}</name></user>'.format(user_id, name)
+        for user_id, name in enumerate(names, 1)
+    ))
+
+
+class PresenceAnalyzerUsersTestCase(unittest.TestCase):
+    """
+    Users directory tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.xml')
+        main.app.config['USERS_XML_FILE'] = self.path
+        self.write('Zenon Z.', 'adam A.', 'Adam B.')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+        main.app.config['USERS_XML_FILE'] = USERS_TEST_XML_FILE
+
+    def write(self, *names):
+        """
+        Writes users XML file.
+        """
+        with open(self.path, 'w') as xmlfile:
+            xmlfile.write(users_xml(*names))
+
+    def test_users_index(self):
+        """
+        Test if users are sorted by name and serialized once.
+        """
+        index = users.get_users_index()
+        self.assertEqual(
+            [user['name'] for user in index.users],
+            ['Adam B.', 'Zenon Z.', 'adam A.'],
+        )
+        self.assertEqual(index.users[1]['user_id'], '1')
+        self.assertIn(
+            'https://intranet.stxnext.pl/api/images/users/2',
+            [user['avatar'] for user in index.users],
+        )
+        self.assertEqual(json.loads(index.body), index.users)
+        self.assertIs(users.get_users_index(), index)
+
+    def test_iter_users(self):
+        """
+        Test streaming users reader against whole tree parsing.
+        """
+        self.assertEqual(
+            list(users.iter_users(USERS_TEST_XML_FILE)),
+            benchmarks.parse_users_tree(USERS_TEST_XML_FILE),
+        )
+        synthetic.write_users_xml(self.path, 50)
+        records = list(users.iter_users(self.path))
+        self.assertEqual(len(records), 50)
+        self.assertEqual(records, benchmarks.parse_users_tree(self.path))
+
+    def test_iter_users_server_after_users(self):
+        """
+        Test if users are yielded once server address is known.
+        """
+        with open(self.path, 'w') as xmlfile:
+            xmlfile.write(
+                '<intranet><users><user id="1"><avatar>/a/1</avatar>'
+                '<name>A</name></user></users><server>'
+                '<host>example.com</host><protocol>http</protocol>'
+                '</server></intranet>'
+            )
+        self.assertEqual(
+            list(users.iter_users(self.path)),
+            [('1', 'A', 'http://example.com/a/1')],
+        )
+        with open(self.path, 'w') as xmlfile:
+            xmlfile.write(
+                '<intranet><users><user id="1"><avatar>/a/1</avatar>'
+                '<name>A</name></user></users></intranet>'
+            )
+        with self.assertRaises(ValueError):
+            list(users.iter_users(self.path))
+
+    def test_users_index_follows_file(self):
+        """
+        Test if index is rebuilt when users file changes.
+        """
+        index = users.get_users_index()
+        self.write('Ewa E.')
+        new_index = users.get_users_index()
+        self.assertIsNot(new_index, index)
+        self.assertEqual([user['name'] for user in new_index.users],
+                         ['Ewa E.'])
+        resp = main.app.test_client().get('/api/v2/users')
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.data, new_index.body)
+
+
+def rounded(value, places=6):
+    """
+    Returns JSON value with floats rounded to given decimal places.
+    """
+    if isinstance(value, float):
+        return round(value, places)
+    if isinstance(value, list):
+        return [rounded(item, places) for item in value]
+    if isinstance(value, dict):
+        return {key: rounded(item, places) for key, item in value.items()}
+    return value
+
+
+class PresenceAnalyzerJSONTestCase(unittest.TestCase):
+    """
+    Pluggable JSON encoders tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update(
+            {
+                'DATA_CSV': TEST_DATA_CSV,
+                'USERS_XML_FILE': USERS_TEST_XML_FILE,
+            }
+        )
+        utils.TIMESTAMPS['get_data'] = 0
+        utils.RESPONSE_CACHE.clear()
+        self.addCleanup(main.app.config.pop, 'JSON_ENCODER', None)
+
+    def installed_encoders(self):
+        """
+        Returns names of installed encoders from JSON_ENCODERS.
+        """
+        return [
+            name for name in utils.JSON_ENCODERS
+            if name == 'json' or utils.json_encoder(name) is not utils.dumps
+        ]
+
+    def test_default_encoder(self):
+        """
+        Test if stdlib json is used by default.
+        """
+        self.assertIs(utils.json_encoder(), json.dumps)
+
+    def test_missing_encoder_falls_back(self):
+        """
+        Test if stdlib json is used when encoder isn't installed.
+        """
+        main.app.config['JSON_ENCODER'] = 'no_such_json_module'
+        self.assertIs(utils.json_encoder(), json.dumps)
+        self.assertEqual(utils.encode([1, 2]), '[1, 2]')
+
+    def test_callable_encoder(self):
+        """
+        Test if callable can be set as encoder.
+        """
+        main.app.config['JSON_ENCODER'] = lambda value: 'encoded'
+        resp = main.app.test_client().get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.data, 'encoded')
+
+    def test_encoders_compatible(self):
+        """
+        Test if encoders give the same values as stdlib json for payloads
+        of all API views; simplejson output has to be byte for byte equal.
+        """
+        payloads = benchmarks.api_payloads(utils.get_data())
+        for name in self.installed_encoders():
+            encoder = utils.json_encoder(name)
+            for shape, results in payloads.iteritems():
+                for payload in results:
+                    expected = json.dumps(payload)
+                    encoded = encoder(payload)
+                    if name in ('json', 'simplejson'):
+                        self.assertEqual(encoded, expected, (name, shape))
+                    self.assertEqual(
+                        rounded(json.loads(encoded)),
+                        rounded(json.loads(expected)),
+                        (name, shape),
+                    )
+
+    def test_views_with_encoders(self):
+        """
+        Test if views give the same values with every installed encoder.
+        """
+        client = main.app.test_client()
+        urls = [
+            '/api/v1/{0}/{1}'.format(view, user_id)
+            for view in ('mean_time_weekday', 'presence_weekday',
+                         'presence_start_end', 'standard_deviation')
+            for user_id in (10, 11, 12)
+        ]
+        expected = [json.loads(client.get(url).data) for url in urls]
+        for name in self.installed_encoders():
+            main.app.config['JSON_ENCODER'] = name
+            utils.RESPONSE_CACHE.clear()
+            self.assertEqual(
+                [rounded(json.loads(client.get(url).data)) for url in urls],
+                rounded(expected),
+                name,
+            )
+
+
+class PresenceAnalyzerMetricsTestCase(unittest.TestCase):
+    """
+    Prometheus metrics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update(
+            {
+                'DATA_CSV': TEST_DATA_CSV,
+                'USERS_XML_FILE': USERS_TEST_XML_FILE,
+            }
+        )
+        self.client = main.app.test_client()
+
+    def sample(self, text, line_start):
+        """
+        Returns value of sample line starting with given text.
+        """
+        for line in text.splitlines():
+            if line.startswith(line_start + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return None
+
+    def test_render(self):
+        """
+        Test text exposition format of counters and histograms.
+        """
+        counter = metrics.Counter('test_total', 'Test counter.', ('kind',))
+        histogram = metrics.Histogram(
+            'test_seconds', 'Test histogram.', buckets=(0.5, 1),
+        )
+        self.addCleanup(metrics.REGISTRY.remove, counter)
+        self.addCleanup(metrics.REGISTRY.remove, histogram)
+        counter.inc(kind='a"b')
+        counter.inc(2, kind='a"b')
+        histogram.observe(0.5)
+        histogram.observe(0.75)
+        histogram.observe(3)
+        text = metrics.render()
+        self.assertIn(
+            '# HELP test_total Test counter.\n'
+            '# TYPE test_total counter\n'
+            'test_total{kind="a\\"b"} 3\n',
+            text,
+        )
+        self.assertIn(
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{le="0.5"} 1\n'
+            'test_seconds_bucket{le="1.0"} 2\n'
+            'test_seconds_bucket{le="+Inf"} 3\n'
+            'test_seconds_sum 4.25\n'
+            'test_seconds_count 3\n',
+            text,
+        )
+
+    def test_instrumentation(self):
+        """
+        Test if requests, data loading and caches are measured.
+        """
+        utils.TIMESTAMPS['get_data'] = 0
+        utils.TIMESTAMPS['get_users_index'] = 0
+        before = self.client.get('/metrics').data
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v2/users')
+        self.client.get('/api/v1/batch')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, metrics.CONTENT_TYPE)
+        text = resp.data
+
+        def increase(line_start):
+            """
+            Returns increase of sample since first scrape.
+            """
+            return (
+                self.sample(text, line_start) -
+                (self.sample(before, line_start) or 0)
+            )
+
+        self.assertEqual(increase(
+            'presence_http_requests_total{endpoint="presence_weekday_view",'
+            'method="GET",status="200"}'
+        ), 1)
+        self.assertEqual(increase(
+            'presence_http_requests_total{endpoint="batch_view",'
+            'method="GET",status="400"}'
+        ), 1)
+        self.assertEqual(increase(
+            'presence_http_request_duration_seconds_count'
+            '{endpoint="users_view_v2"}'
+        ), 1)
+        self.assertGreaterEqual(
+            increase('presence_memorize_hits_total{function="get_data"}'), 1,
+        )
+        self.assertGreaterEqual(increase(
+            'presence_memorize_rebuild_duration_seconds_count'
+            '{function="get_data"}'
+        ), 1)
+        self.assertGreaterEqual(
+            increase('presence_users_xml_parse_duration_seconds_count'), 1,
+        )
+        self.assertEqual(self.sample(text, 'presence_data_rows'), 9)
+        self.assertIsNotNone(self.sample(
+            text, 'presence_lru_cache_entries{cache="presence_weekday_view"}',
+        ))
+
+    def test_rejected_rows(self):
+        """
+        Test if rejected CSV rows are counted by reason.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                'user_id,date\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '10,2013-09-11,25:00:00,17:59:52\n'
+            )
+        key = 'presence_data_rows_rejected_total{{reason="{0}"}}'
+        before = metrics.render()
+        utils.PresenceLoader().load(path)
+        after = metrics.render()
+        for reason in ('wrong_field_count', 'invalid'):
+            self.assertEqual(
+                self.sample(after, key.format(reason)) -
+                (self.sample(before, key.format(reason)) or 0),
+                1,
+            )
+
+
+class PresenceAnalyzerProfilingTestCase(unittest.TestCase):
+    """
+    Request profiling tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.options = {
+            'PROFILE': True,
+            'PROFILE_DIR': self.tmpdir,
+            'DATA_CSV': TEST_DATA_CSV,
+            'USERS_XML_FILE': USERS_TEST_XML_FILE,
+        }
+        main.app.config.update(self.options)
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        for key in list(main.app.config):
+            if key.startswith('PROFILE'):
+                main.app.config.pop(key)
+        shutil.rmtree(self.tmpdir)
+
+    def test_profile_on_header(self):
+        """
+        Test if only requests with profiling header are profiled.
+        """
+        main.app.config['PROFILE_TOKEN'] = 'secret'
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(profiling.list_profiles(self.tmpdir), [])
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10', headers={'X-Profile': 'secret'},
+        )
+        self.assertEqual(json.loads(resp.data)[2], ['Tue', 30047])
+        profiles = profiling.list_profiles(self.tmpdir)
+        self.assertEqual(len(profiles), 1)
+        self.assertIn('GET-api_v1_presence_weekday_10', profiles[0]['name'])
+        self.assertGreater(profiles[0]['calls'], 0)
+
+        output = StringIO()
+        profiling.summarize(profiles[0]['path'], stream=output)
+        self.assertIn('wsgi_app', output.getvalue())
+
+    def test_profile_token(self):
+        """
+        Test if header has to match token and is ignored without it.
+        """
+        self.client.get('/healthz', headers={'X-Profile': '1'})
+        self.assertEqual(profiling.list_profiles(self.tmpdir), [])
+        main.app.config['PROFILE_TOKEN'] = 'secret'
+        self.client.get('/healthz', headers={'X-Profile': '1'})
+        self.assertEqual(profiling.list_profiles(self.tmpdir), [])
+        self.client.get('/healthz', headers={'X-Profile': 'secret'})
+        self.assertEqual(len(profiling.list_profiles(self.tmpdir)), 1)
+
+    def test_sampling_and_limit(self):
+        """
+        Test if sampled requests are profiled and old profiles removed.
+        """
+        main.app.config.update(
+            {'PROFILE_SAMPLE_RATE': 1.0, 'PROFILE_MAX_FILES': 2},
+        )
+        with open(os.path.join(self.tmpdir, 'notes.txt'), 'w'):
+            pass
+        for _ in range(4):
+            resp = self.client.get('/api/v1/summary')
+            self.assertEqual(len(resp.data.splitlines()), 2)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 3)
+        self.assertEqual(len(profiling.list_profiles(self.tmpdir)), 2)
+        main.app.config['PROFILE'] = False
+        self.client.get('/healthz', headers={'X-Profile': '1'})
+        self.assertEqual(len(os.listdir(self.tmpdir)), 3)
+
+
+def exiting_child(queue, code):  # pylint: disable=unused-argument
+    """
+    Benchmark child process exiting without result.
+    """
+    os._exit(code)  # pylint: disable=protected-access
+
+
+def hanging_child(queue, seconds):  # pylint: disable=unused-argument
+    """
+    Benchmark child process not finishing in time.
+    """
+    time.sleep(seconds)
+
+
+class PresenceAnalyzerBenchmarksTestCase(unittest.TestCase):
+    """
+    Synthetic data and benchmark suite tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_noisy_presence_csv(self):
+        """
+        Test if noise lines are rejected or override entries as expected.
+        """
+        path = os.path.join(self.tmpdir, 'data.csv')
+        rows = synthetic.write_presence_csv(path, 10, 50, noise=0.2)
+        with open(path) as csvfile:
+            lines = len(csvfile.readlines())
+        self.assertGreater(lines, 500)
+        loader = utils.PresenceLoader()
+        data = loader.load(path)
+        self.assertEqual(loader.last_stats['rows'], rows)
+        self.assertEqual(
+            loader.last_stats['skipped'] + loader.last_stats['invalid'],
+            lines - rows,
+        )
+        self.assertGreater(loader.last_stats['invalid'], 0)
+        self.assertEqual(data.rows_count, 500)
+        self.assertEqual(
+            synthetic.write_presence_csv(path, 10, 50), 500,
+        )
+
+    def test_noisy_users_xml(self):
+        """
+        Test if noise leaves users out of XML file.
+        """
+        path = os.path.join(self.tmpdir, 'users.xml')
+        synthetic.write_users_xml(path, 200, noise=0.5)
+        left = len(users.parse_users(path))
+        self.assertGreater(left, 50)
+        self.assertLess(left, 150)
+
+    def test_generator_command(self):
+        """
+        Test if generator writes both files.
+        """
+        csv_path = os.path.join(self.tmpdir, 'data.csv')
+        xml_path = os.path.join(self.tmpdir, 'users.xml')
+        self.addCleanup(setattr, sys, 'stdout', sys.stdout)
+        sys.stdout = StringIO()
+        self.assertEqual(synthetic.main([csv_path, xml_path]), 2)
+        self.assertEqual(synthetic.main([csv_path, xml_path, '3', '4']), 0)
+        self.assertEqual(len(users.parse_users(xml_path)), 3)
+        self.assertEqual(utils.PresenceLoader().load(csv_path).rows_count, 12)
+
+    def test_check_thresholds(self):
+        """
+        Test if results over thresholds are reported.
+        """
+        self.assertEqual(
+            benchmarks.check_thresholds(
+                {'a_seconds': 1.5, 'b_seconds': 0.5},
+                {'a_seconds': 1.0, 'b_seconds': 1.0, 'c_seconds': 1.0},
+            ),
+            ['a_seconds = 1.5 exceeds 1.0', 'c_seconds = None exceeds 1.0'],
+        )
+
+    def test_scaling_benchmark(self):
+        """
+        Test if scaling results are saved and checked against thresholds.
+        """
+        output = os.path.join(self.tmpdir, 'results.json')
+        thresholds = os.path.join(self.tmpdir, 'thresholds.json')
+        with open(thresholds, 'w') as thresholds_file:
+            json.dump({
+                'rows_200_ingest_seconds': 60,
+                'rows_200_users_v2_p95_seconds': 0,
+            }, thresholds_file)
+        result = benchmarks.bench_scaling('100,200', 10, 0.1, 3, output,
+                                          thresholds)
+        self.assertEqual(result['rows_100_users'], 10)
+        self.assertEqual(result['rows_200_rows'], 200)
+        for name, _ in benchmarks.VIEW_URLS:
+            self.assertIn('rows_200_{0}_p95_seconds'.format(name), result)
+        self.assertEqual(len(result['regressions']), 1)
+        self.assertIn('users_v2', result['regressions'][0])
+        with open(output) as output_file:
+            self.assertEqual(json.load(output_file), result)
+
+    def test_run_in_process_failures(self):
+        """
+        Test if crashed or hanging child process raises instead of blocking.
+        """
+        with self.assertRaisesRegexp(benchmarks.BenchmarkError,
+                                     'exited with code 3'):
+            benchmarks.run_in_process(exiting_child, (3,))
+        started = time.time()
+        with self.assertRaisesRegexp(benchmarks.BenchmarkError, 'timed out'):
+            benchmarks.run_in_process(hanging_child, (60,), timeout=1)
+        self.assertLess(time.time() - started, 10)
+
+    def test_scaling_benchmark_failure(self):
+        """
+        Test if failed size is reported as regression.
+        """
+        # pylint: disable=protected-access
+        self.addCleanup(setattr, benchmarks, '_ingest_and_serve',
+                        benchmarks._ingest_and_serve)
+        benchmarks._ingest_and_serve = lambda queue, *args: os._exit(1)
+        result = benchmarks.bench_scaling('100', 10, 0, 1)
+        self.assertEqual(
+            result['regressions'],
+            ['rows_100 failed: <lambda> exited with code 1'],
+        )
+        self.assertNotIn('rows_100_rows', result)
+
+
+class PresenceAnalyzerLoadTestTestCase(unittest.TestCase):
+    """
+    Load test harness tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update(
+            {
+                'DATA_CSV': TEST_DATA_CSV,
+                'USERS_XML_FILE': USERS_TEST_XML_FILE,
+            }
+        )
+
+    def test_request_paths(self):
+        """
+        Test if paths follow the mix and are reproducible.
+        """
+        paths = loadtest.request_paths([10, 11], 200, seed=1)
+        self.assertEqual(len(paths), 200)
+        self.assertEqual(paths, loadtest.request_paths([10, 11], 200, seed=1))
+        self.assertIn('/api/v2/users', paths)
+        self.assertIn('/api/v1/presence_weekday/11', paths)
+        batch = [path for path in paths if 'batch' in path]
+        self.assertTrue(batch)
+        self.assertIn(batch[0], (
+            '/api/v1/batch?user_ids=10,11',
+            '/api/v1/batch?user_ids=11,10',
+        ))
+
+    def test_run_level(self):
+        """
+        Test if all requests are sent and failures are counted.
+        """
+        statuses = {'/ok': 200, '/cached': 304, '/missing': 404}
+
+        def send(path):
+            """
+            Fake sender.
+            """
+            if path == '/broken':
+                raise IOError('broken')
+            return statuses[path]
+
+        result = loadtest.run_level(
+            send, ['/ok', '/cached', '/missing', '/broken'] * 5, 3,
+        )
+        self.assertEqual(result['requests'], 20)
+        self.assertEqual(result['errors'], 10)
+        self.assertEqual(result['concurrency'], 3)
+        self.assertGreater(result['throughput'], 0)
+        self.assertLessEqual(result['p50'], result['p99'])
+
+    def test_load_test(self):
+        """
+        Test load test straight against application and behind paster's
+        threadpool.
+        """
+        results = loadtest.load_test(main.app, [1, 2], 20)
+        self.assertEqual(
+            [(result['setting'], result['concurrency'], result['requests'],
+              result['errors']) for result in results],
+            [('wsgi', 1, 20, 0), ('wsgi', 2, 20, 0)],
+        )
+        results = loadtest.load_test(main.app, [2], 10, workers=[1, 3])
+        self.assertEqual(
+            [(result['setting'], result['errors']) for result in results],
+            [('threadpool_workers=1', 0), ('threadpool_workers=3', 0)],
+        )
+        table = loadtest.report(results).splitlines()
+        self.assertEqual(len(table), 3)
+        self.assertIn('p99 ms', table[0])
+
+
+class UsersXMLHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in of users XML server answering with responses queued by test.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Sends next queued (status, body, delay) response, the last one is
+        repeated.
+        """
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if len(server.responses) > 1:
+            status, body, delay = server.responses.pop(0)
+        else:
+            status, body, delay = server.responses[0]
+        time.sleep(delay)
+        self.send_response(status)
+        if status == 200:
+            self.send_header('ETag', '"v1"')
+            self.send_header('Last-Modified', 'Mon, 05 Jan 2015 10:00:00 GMT')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Keeps test output clean.
+        """
+
+
+class UsersXMLServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded stand-in server, so slow responses don't delay retries.
+    """
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        """
+        Ignores clients which gave up waiting.
+        """
+
+
+class PresenceAnalyzerCronTestCase(unittest.TestCase):
+    """
+    Users XML synchronization tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.xml')
+        self.server = UsersXMLServer(('127.0.0.1', 0), UsersXMLHandler)
+        self.server.requests = []
+        self.server.responses = [(200, users_xml('Adam A.', 'Ewa E.'), 0)]
+        self.url = 'http://127.0.0.1:{0}/users.xml'.format(
+            self.server.server_address[1],
+        )
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def sync(self, **kwargs):
+        """
+        Runs synchronization with short timeout and no retry delay.
+        """
+        kwargs.setdefault('timeout', 2)
+        kwargs.setdefault('attempts', 2)
+        return cron.sync_users_file(
+            self.url, self.path, retry_delay=0, **kwargs
+        )
+
+    def test_conditional_get(self):
+        """
+        Test if the file is downloaded once and then only revalidated.
+        """
+        self.assertTrue(self.sync())
+        self.assertEqual(len(users.parse_users(self.path)), 2)
+        self.assertEqual(oct(os.stat(self.path).st_mode & 0o777), '0644')
+        self.assertNotIn('if-none-match', self.server.requests[0])
+
+        self.server.responses = [(304, '', 0)]
+        modified = os.stat(self.path).st_mtime
+        self.assertFalse(self.sync())
+        self.assertEqual(self.server.requests[1]['if-none-match'], '"v1"')
+        self.assertEqual(
+            self.server.requests[1]['if-modified-since'],
+            'Mon, 05 Jan 2015 10:00:00 GMT',
+        )
+        self.assertEqual(os.stat(self.path).st_mtime, modified)
+
+        # validators are not sent when the file itself is gone
+        os.remove(self.path)
+        self.server.responses = [(200, users_xml('Adam A.'), 0)]
+        self.assertTrue(self.sync())
+        self.assertNotIn('if-none-match', self.server.requests[2])
+        self.assertEqual(len(users.parse_users(self.path)), 1)
+
+    def test_invalid_xml(self):
+        """
+        Test if invalid or empty XML never replaces the file.
+        """
+        self.sync()
+        with open(self.path) as xmlfile:
+            content = xmlfile.read()
+        for body in ('<intranet><users>', users_xml()):
+            self.server.responses = [(200, body, 0)]
+            with self.assertRaises(cron.UsersSyncError):
+                self.sync(attempts=1)
+            with open(self.path) as xmlfile:
+                self.assertEqual(xmlfile.read(), content)
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)),
+            ['users.xml', 'users.xml' + cron.STATE_SUFFIX],
+        )
+
+    def test_retries(self):
+        """
+        Test if server errors and timeouts are retried boundedly.
+        """
+        self.server.responses = [
+            (500, 'error', 0), (200, users_xml('Adam A.'), 0),
+        ]
+        self.assertTrue(self.sync())
+        self.assertEqual(len(self.server.requests), 2)
+
+        self.server.responses = [(200, users_xml('Ewa E.'), 0.5)]
+        with self.assertRaises(cron.UsersSyncError):
+            self.sync(timeout=0.1, attempts=3)
+        self.assertEqual(len(self.server.requests), 5)
+
+        self.server.responses = [(404, 'missing', 0)]
+        with self.assertRaises(cron.UsersSyncError):
+            self.sync(attempts=3)
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(users.parse_users(self.path)[0]['name'], 'Adam A.')
+
+
 def suite():
     """
     Default test suite.
@@ -446,6 +2473,17 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStatsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerVectorizedTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUsersTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerJSONTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerMetricsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerProfilingTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerBenchmarksTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLoadTestTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerCronTestCase))
     return base_suite
 
 
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Users directory read from users XML file.
+"""
+import locale
+import operator
+import threading
+import time
+
+from lxml import etree
+
+from presence_analyzer import metrics
+from presence_analyzer.main import app
+from presence_analyzer.utils import (
+    Serialized,
+    encode,
+    file_signature,
+    memorize,
+)
+
+# setlocale() changes state of the whole process
+LOCALE_LOCK = threading.Lock()
+
+
+def iter_users(path):
+    """
+    Yields (user_id, name, avatar_url) tuples from users XML file.
+
+    File is read with iterparse and every processed element is cleared,
+    so memory use doesn't depend on size of the file.
+    """
+    # pylint: disable=no-member
+    url_base = None
+    waiting = []
+    for _, elem in etree.iterparse(path, events=('end',)):
+        if elem.tag == 'server':
+            url_base = "{}://{}".format(
+                elem.findtext('protocol'), elem.findtext('host'),
+            )
+        elif elem.tag == 'user':
+            waiting.append(
+                (elem.get('id'), elem.findtext('name'),
+                 elem.findtext('avatar')),
+            )
+        else:
+            continue
+        # users are kept only until server address is known
+        if url_base is not None:
+            for user_id, name, avatar in waiting:
+                yield user_id, name, '{}{}'.format(url_base, avatar)
+            waiting = []
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    if waiting:
+        raise ValueError('No server element in {0}'.format(path))
+
+
+def parse_users(path):
+    """
+    Extracts users from XML file.
+
+    Returns list of dicts with 'user_id', 'name' and 'avatar' keys.
+    """
+    return [
+        {'user_id': user_id, 'name': name, 'avatar': avatar}
+        for user_id, name, avatar in iter_users(path)
+    ]
+
+
+def collation_key(name):
+    """
+    Returns key sorting names according to LC_COLLATE locale.
+    """
+    return locale.strxfrm((name or '').encode('utf-8'))
+
+
+class UsersIndex(object):
+    """
+    Users sorted by name and their serialized list.
+
+    Version and modified timestamp identify the source file.
+    """
+
+    def __init__(self, users, version=None, modified=0):
+        self.version = version
+        self.modified = modified
+        with LOCALE_LOCK:
+            locale.setlocale(locale.LC_COLLATE, '')
+            keyed = [(collation_key(user['name']), user) for user in users]
+        keyed.sort(key=operator.itemgetter(0))
+        self.users = [user for _, user in keyed]
+        self.body = Serialized(encode(self.users))
+
+
+@memorize(600, watch=('USERS_XML_FILE',))
+def get_users_index():
+    """
+    Returns UsersIndex of users XML file, rebuilt when the file changes.
+    """
+    path = app.config['USERS_XML_FILE']
+    signature = file_signature(path)
+    started = time.time()
+    users = parse_users(path)
+    metrics.USERS_XML_PARSE_DURATION.observe(time.time() - started)
+    mtime, size, inode = signature
+    return UsersIndex(
+        users,
+        version='{0:x}-{1:x}-{2:x}'.format(inode, size, int(mtime * 1000000)),
+        modified=mtime,
+    )
+
+
+def users_data_source():
+    """
+    Returns version and modification time of users directory.
+    """
+    index = get_users_index()
+    return index.version, index.modified
@@ -4,72 +4,511 @@ Helper functions used in views.
 """
 
 import csv
+import hashlib
+import importlib
 import logging
-import time
+import mmap
+import multiprocessing
+import os
+import sys
 import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
 from json import dumps
 from math import sqrt
 
-from flask import Response
+from flask import Response, has_request_context, request
 
+from presence_analyzer import metrics
 from presence_analyzer.main import app
+from presence_analyzer.snapshot import (
+    SnapshotError,
+    file_digest,
+    read_snapshot,
+    tail_digest,
+    write_snapshot,
+)
+from presence_analyzer.store import (
+    PresenceData,
+    PresenceDataBuilder,
+    build_from_parts,
+)
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
 CACHE = {}
 TIMESTAMPS = {}
+SIGNATURES = {}
+LRU_CACHES = {}
+DEFAULT_MAX_ENTRIES = 1024
+# smaller amounts of new lines aren't worth starting worker processes
+PARALLEL_MIN_BYTES = 1024 * 1024
+
+# encoders giving output with the same values as stdlib json; simplejson
+# output is byte for byte the same, ujson is compact and rounds floats
+# to 9 decimal places
+JSON_ENCODERS = ('json', 'simplejson', 'ujson')
+ENCODERS = {'json': dumps}
+# gzipped body is a different representation, so it gets its own ETag
+GZIP_ETAG_SUFFIX = '-gzip'
+
+
+class Serialized(str):
+    """
+    Already serialized JSON, jsonify returns it as is.
+    """
 
 
-def jsonify(function):
+def validators(sources):
+    """
+    Returns ETag, Last-Modified datetime and data versions of response
+    to current request.
+
+    Sources are functions returning (version, modification time) of data
+    which the response depends on. Versions are (source name, version)
+    pairs. ETag changes whenever any of the sources or request URL
+    changes.
+    """
+    results = [(source.__name__, source()) for source in sources]
+    versions = tuple((name, version) for name, (version, _) in results)
+    etag = hashlib.sha1('{0!r}{1}'.format(
+        list(versions), request.full_path,
+    )).hexdigest()
+    modified = max(modified for _, (_, modified) in results)
+    return etag, datetime.utcfromtimestamp(int(modified)), versions
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Checks if client's copy of response to current request is current.
+    Copy may be either plain or gzipped variant of response.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag) or \
+            request.if_none_match.contains_weak(etag + GZIP_ETAG_SUFFIX)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def jsonify(function=None, sources=None):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Responses depend on given data sources (see validators), presence data
+    by default. Use as @jsonify or @jsonify(sources=(...)). Responses
+    get ETag, Last-Modified and Cache-Control (HTTP_CACHE_CONTROL
+    option) headers. If client's copy is current, 304 Not Modified is
+    returned without calling wrapped function.
+
+    Encoded bodies are kept in RESPONSE_CACHE keyed by view, request URL
+    and data versions. With RESPONSE_GZIP option set, bodies of at least
+    RESPONSE_GZIP_MIN_SIZE bytes are also kept gzipped and sent to clients
+    accepting gzip encoding, with GZIP_ETAG_SUFFIX appended to ETag.
     """
+    if function is None:
+        return partial(jsonify, sources=sources)
+
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
+        if not has_request_context():
+            return Response(
+                encode(function(*args, **kwargs)),
+                mimetype='application/json',
+            )
+
+        etag, last_modified, versions = validators(
+            sources or (presence_data_source,),
+        )
+        if is_not_modified(etag, last_modified):
+            response = Response(status=304)
+            if app.config.get('RESPONSE_GZIP'):
+                response.vary.add('Accept-Encoding')
+                # validator of the variant client has
+                if request.if_none_match.contains_weak(
+                        etag + GZIP_ETAG_SUFFIX):
+                    etag += GZIP_ETAG_SUFFIX
+        else:
+            key = (function.__name__, request.full_path, versions)
+            found, bodies = RESPONSE_CACHE.lookup(key)
+            if not found:
+                started = time.time()
+                bodies = compressed(encode(function(*args, **kwargs)))
+                RESPONSE_CACHE.store(key, bodies, time.time() - started)
+            body, gzipped = bodies
+            response = Response(mimetype='application/json')
+            if gzipped is not None:
+                response.vary.add('Accept-Encoding')
+                if request.accept_encodings['gzip']:
+                    body = gzipped
+                    response.content_encoding = 'gzip'
+                    etag += GZIP_ETAG_SUFFIX
+            response.set_data(body)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = app.config.get(
+            'HTTP_CACHE_CONTROL', 'no-cache',
         )
+        return response
     return inner
 
 
-def memorize(period):
+def compressed(body):
+    """
+    Returns (body, gzipped body) tuple. Gzipped body is None unless
+    RESPONSE_GZIP option is set and body is long enough to be worth it.
+    """
+    if not app.config.get('RESPONSE_GZIP') or \
+            len(body) < app.config.get('RESPONSE_GZIP_MIN_SIZE', 1024):
+        return body, None
+    compressor = zlib.compressobj(
+        app.config.get('RESPONSE_GZIP_LEVEL', 6),
+        zlib.DEFLATED,
+        16 + zlib.MAX_WBITS,  # gzip container
+    )
+    return body, compressor.compress(body) + compressor.flush()
+
+
+def json_encoder(name=None):
+    """
+    Returns dumps function of JSON encoder set in JSON_ENCODER app config
+    option: name of a module from JSON_ENCODERS (or any other module with
+    dumps function) or a callable. Falls back to stdlib json when module
+    isn't installed.
+    """
+    name = name or app.config.get('JSON_ENCODER', 'json')
+    if callable(name):
+        return name
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        pass
+    try:
+        encoder = importlib.import_module(name).dumps
+    except ImportError:
+        log.warning('JSON encoder %s is not installed, using json', name)
+        encoder = dumps
+    ENCODERS[name] = encoder
+    return encoder
+
+
+def encode(result):
+    """
+    Serializes result to JSON unless it's already Serialized.
+    """
+    if isinstance(result, Serialized):
+        return result
+    return json_encoder()(result)
+
+
+def file_signature(path):
+    """
+    Returns (mtime, size, inode) of file, or None if it can't be stat'ed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def memorize(period, watch=()):
     """
     Memorizing decorator. Returning cached data
-    if its validity period is not expired.
+    if its validity period is not expired and none of watched files
+    (given as app config keys) has changed.
+
+    With CACHE_STALE_WHILE_REVALIDATE option set, expired data is still
+    returned while a background thread rebuilds it.
     """
 
     def _decoration_wrapper(func):
         lock = threading.Lock()
 
+        def _is_valid(cache_key, signature, now):
+            return (
+                TIMESTAMPS.get(cache_key, now) > now and
+                SIGNATURES.get(cache_key) == signature
+            )
+
+        def _rebuild(cache_key, signature, now, args, kwargs):
+            started = time.time()
+            ret = func(*args, **kwargs)
+            metrics.MEMORIZE_REBUILD_DURATION.observe(
+                time.time() - started, function=cache_key,
+            )
+            CACHE[cache_key] = ret
+            SIGNATURES[cache_key] = signature
+            TIMESTAMPS[cache_key] = now + period
+            return ret
+
+        def _refresh(cache_key, signature, now, args, kwargs):
+            try:
+                _rebuild(cache_key, signature, now, args, kwargs)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Background refresh of %s failed', cache_key)
+            finally:
+                lock.release()
+
+        @wraps(func)
         def _caching_wrapper(*args, **kwargs):
             cache_key = func.__name__
+            signature = tuple(
+                file_signature(app.config[key]) for key in watch
+            )
             now = time.time()
-            if TIMESTAMPS.get(cache_key, now) > now:
+            if _is_valid(cache_key, signature, now):
+                metrics.MEMORIZE_HITS.inc(function=cache_key)
                 return CACHE[cache_key]
+            if cache_key in CACHE and \
+                    app.config.get('CACHE_STALE_WHILE_REVALIDATE'):
+                metrics.MEMORIZE_HITS.inc(function=cache_key)
+                # refresh may finish before we return, so take value first
+                stale = CACHE[cache_key]
+                if lock.acquire(False):
+                    thread = threading.Thread(
+                        target=_refresh,
+                        args=(cache_key, signature, now, args, kwargs),
+                    )
+                    thread.daemon = True
+                    thread.start()
+                return stale
+            metrics.MEMORIZE_MISSES.inc(function=cache_key)
+            waiting = time.time()
             with lock:
-                if TIMESTAMPS.get(cache_key, now) > now:
+                metrics.MEMORIZE_LOCK_WAIT.observe(
+                    time.time() - waiting, function=cache_key,
+                )
+                if _is_valid(cache_key, signature, now):
                     return CACHE[cache_key]
-                ret = func(*args, **kwargs)
-                CACHE[cache_key] = ret
-                TIMESTAMPS[cache_key] = now + period
-                return ret
+                return _rebuild(cache_key, signature, now, args, kwargs)
+        return _caching_wrapper
+    return _decoration_wrapper
+
+
+class LRUCache(object):
+    """
+    Least recently used cache bounded by amount of entries and their size.
+
+    Limits equal to None are taken from MEMOIZE_MAX_ENTRIES and
+    MEMOIZE_MAX_BYTES app config options (prefix is given by config_prefix
+    class attribute). Size of entries isn't limited by default.
+    """
+    config_prefix = 'MEMOIZE'
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'rebuilds': 0,
+            'rebuild_time': 0.0,
+        }
+
+    def lookup(self, key):
+        """
+        Returns (found, value) tuple, marking found entry as recently used.
+        """
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                self.stats['misses'] += 1
+                return False, None
+            self.entries[key] = value, size
+            self.stats['hits'] += 1
+            return True, value
+
+    def store(self, key, value, rebuild_time=0.0):
+        """
+        Stores value, evicting least recently used entries over limits.
+        """
+        max_entries = self.max_entries or app.config.get(
+            self.config_prefix + '_MAX_ENTRIES', DEFAULT_MAX_ENTRIES,
+        )
+        max_bytes = self.max_bytes or app.config.get(
+            self.config_prefix + '_MAX_BYTES',
+        )
+        size = deep_sizeof(value)
+        with self.lock:
+            self.stats['rebuilds'] += 1
+            self.stats['rebuild_time'] += rebuild_time
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            if max_bytes and size > max_bytes:
+                return
+            self.entries[key] = value, size
+            self.nbytes += size
+            while (max_entries and len(self.entries) > max_entries) or \
+                    (max_bytes and self.nbytes > max_bytes):
+                self.nbytes -= self.entries.popitem(last=False)[1][1]
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def info(self):
+        """
+        Returns cache statistics.
+        """
+        with self.lock:
+            info = dict(self.stats, entries=len(self.entries))
+            info['bytes'] = self.nbytes
+        return info
+
+
+class ResponseCache(LRUCache):
+    """
+    LRUCache of encoded responses, limited by RESPONSE_CACHE_MAX_ENTRIES
+    and RESPONSE_CACHE_MAX_BYTES app config options.
+
+    Keys end with (source name, version) pairs of data the response was
+    computed from. Only responses of the latest data versions are kept:
+    storing a response of a new version of a source evicts the older
+    responses depending on that source.
+    """
+    config_prefix = 'RESPONSE_CACHE'
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        super(ResponseCache, self).__init__(max_entries, max_bytes)
+        self.versions = {}
+
+    def store(self, key, value, rebuild_time=0.0):
+        """
+        Stores value, evicting responses of outdated data versions.
+        """
+        with self.lock:
+            changed = set(
+                name for name, version in key[-1]
+                if self.versions.get(name, version) != version
+            )
+            self.versions.update(key[-1])
+            if changed:
+                for old_key in list(self.entries):
+                    if any(name in changed for name, _ in old_key[-1]):
+                        self.nbytes -= self.entries.pop(old_key)[1]
+                        self.stats['evictions'] += 1
+        super(ResponseCache, self).store(key, value, rebuild_time)
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        super(ResponseCache, self).clear()
+        self.versions = {}
+
+
+RESPONSE_CACHE = LRU_CACHES['responses'] = ResponseCache()
+
+
+def lru_memorize(max_entries=None, max_bytes=None, version=None):
+    """
+    Memorizing decorator keyed by function arguments.
+
+    Results are kept in bounded LRUCache, see its docstring for limits.
+    Optional version callable is made part of the key, so results computed
+    from outdated data aren't returned. Calls with different arguments
+    don't wait for each other.
+
+    Decorated function gets cache_info() and cache_clear() attributes, and
+    key_locks of calls in progress.
+    """
+
+    def _decoration_wrapper(func):
+        cache = LRU_CACHES[func.__name__] = LRUCache(max_entries, max_bytes)
+        locks = {}
+        locks_lock = threading.Lock()
+
+        @wraps(func)
+        def _caching_wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            if version is not None:
+                key += (version(),)
+            found, value = cache.lookup(key)
+            if found:
+                return value
+            with locks_lock:
+                key_lock = locks.setdefault(key, threading.Lock())
+            try:
+                with key_lock:
+                    # someone else could have computed it while we were
+                    # waiting
+                    with cache.lock:
+                        found = key in cache.entries
+                        if found:
+                            value = cache.entries[key][0]
+                    if not found:
+                        started = time.time()
+                        value = func(*args, **kwargs)
+                        cache.store(key, value, time.time() - started)
+            finally:
+                with locks_lock:
+                    locks.pop(key, None)
+            return value
+
+        _caching_wrapper.cache_info = cache.info
+        _caching_wrapper.cache_clear = cache.clear
+        _caching_wrapper.key_locks = locks
         return _caching_wrapper
     return _decoration_wrapper
 
 
-@memorize(600)
+def lru_cache_stats():
+    """
+    Returns statistics of all lru_memorize caches keyed by function name.
+    """
+    return {name: cache.info() for name, cache in LRU_CACHES.iteritems()}
+
+
+@metrics.collector
+def lru_cache_metrics():
+    """
+    Returns lru_memorize and response cache statistics as metrics.
+    """
+    caches = lru_cache_stats()
+    return [
+        metrics.Snapshot(
+            kind,
+            'presence_lru_cache_{0}'.format(name),
+            documentation,
+            ('cache',),
+            {(cache,): info[key] for cache, info in caches.iteritems()},
+        )
+        for kind, name, key, documentation in (
+            ('counter', 'hits_total', 'hits', 'LRU cache hits.'),
+            ('counter', 'misses_total', 'misses', 'LRU cache misses.'),
+            ('counter', 'evictions_total', 'evictions',
+             'LRU cache entries evicted over limits or by new data.'),
+            ('gauge', 'entries', 'entries', 'LRU cache entries.'),
+            ('gauge', 'bytes', 'bytes', 'Approximate size of LRU cache.'),
+        )
+    ]
+
+
+@memorize(600, watch=('DATA_CSV',))
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
-    It creates structure like this:
+    It creates read-only mapping (see presence_analyzer.store) like this:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -83,25 +522,435 @@ def get_data():
         }
     }
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
+    data = LOADER.load(
+        app.config['DATA_CSV'],
+        app.config.get('DATA_SNAPSHOT'),
+        save=app.config.get('DATA_SNAPSHOT_WRITE', True),
+    )
+    metrics.DATA_ROWS.set(data.rows_count)
+    return data
+
+
+def data_version():
+    """
+    Returns version of currently loaded presence data.
+    """
+    return get_data().version
+
+
+def presence_data_source():
+    """
+    Returns version and modification time of presence data.
+    """
+    data = get_data()
+    return data.version, data.modified
+
+
+class PresenceLoader(object):
+    """
+    Loads presence CSV file incrementally.
+
+    The file is append-only, so loader remembers its identity, how many
+    bytes were consumed and digest of the last of them. Next load parses
+    only appended lines and merges them into previous data. Truncated,
+    replaced or rewritten file is loaded from scratch.
+
+    With snapshot path given, loading from scratch starts from the snapshot
+    (see presence_analyzer.snapshot) if consumed part of the file didn't
+    change, and snapshot is rewritten if new lines were parsed then.
+    Incremental loads never write it, that's left to
+    presence_analyzer.precompute.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.identity = None
+        self.offset = 0
+        self.size = self.mtime = None
+        self.tail = None
+        self.digest = hashlib.sha1()
+        self.data = PresenceData()
+        self.last_stats = None
+
+    def load(self, path, snapshot=None, workers=1, save=True):
+        """
+        Returns presence data from given file, parsing only new lines.
+
+        With more than one worker, large amounts of new lines are parsed
+        in parallel, see parse_parallel. Without save, snapshot is only
+        read, e.g. when it's written by precompute job.
+        """
+        stat = os.stat(path)
+        identity = (stat.st_dev, stat.st_ino)
+        if stat.st_size == self.size and stat.st_mtime == self.mtime \
+                and (path, identity) == (self.path, self.identity):
+            return self.data
+        reload = path != self.path or identity != self.identity \
+            or stat.st_size <= self.offset
+        if not reload and self.offset \
+                and tail_digest(path, self.offset) != self.tail:
+            # rewritten in place, e.g. by cp, keeping the inode
+            reload = True
+        if reload:
+            log.info('Loading presence data from %s', path)
+            self.path, self.identity = path, identity
+            self.offset, self.data, self.tail = 0, PresenceData(), None
+            self.digest = hashlib.sha1()
+            if snapshot:
+                self.restore(snapshot, stat)
+
+        if workers > 1 and \
+                stat.st_size - self.offset >= PARALLEL_MIN_BYTES:
+            parts, consumed, stats = parse_parallel(
+                path, self.offset, stat.st_size, workers,
+            )
+            build = partial(build_from_parts, parts)
+        else:
+            builder = PresenceDataBuilder()
+            with open(path, 'rb') as csvfile:
+                csvfile.seek(self.offset)
+                lines = []
+                stats = parse_presence_lines(
+                    complete_lines(csvfile, lines), builder,
+                )
+            consumed = sum(lines)
+            build = builder.build
+        if self.digest is None and consumed:
+            # restored from snapshot without hashing, see restore
+            self.digest = file_digest(path, self.offset)
+        if self.digest is not None:
+            file_digest(path, consumed, self.digest, start=self.offset)
+        self.offset += consumed
+        if consumed:
+            self.tail = tail_digest(path, self.offset)
+        self.size, self.mtime = stat.st_size, stat.st_mtime
+        self.data = build(
+            base=self.data,
+            version='{0:x}-{1:x}-{2:x}'.format(
+                stat.st_ino, self.offset, int(stat.st_mtime * 1000000),
+            ),
+            modified=stat.st_mtime,
+        )
+        self.last_stats = stats
+        metrics.DATA_PARSE_DURATION.observe(stats['seconds'])
+        metrics.DATA_ROWS_PARSED.inc(stats['rows'])
+        metrics.DATA_ROWS_REJECTED.inc(
+            stats['skipped'], reason='wrong_field_count',
+        )
+        metrics.DATA_ROWS_REJECTED.inc(stats['invalid'], reason='invalid')
+        log.info(
+            'Parsed %(rows)d presence rows in %(seconds).3fs '
+            '(%(rows_per_second)d rows/s)',
+            stats,
+        )
+        if snapshot and save and reload and consumed:
+            self.save(snapshot)
+        return self.data
+
+    def restore(self, snapshot, stat):
+        """
+        Starts from snapshot if it was made from the current file.
+
+        File of the same inode, size and mtime as recorded in snapshot is
+        taken as unchanged if the last consumed bytes match. Otherwise its
+        consumed part is hashed; then digest is computed lazily, when new
+        lines are parsed.
+        """
+        try:
+            header, data = read_snapshot(snapshot)
+            if header['offset'] > stat.st_size:
+                raise SnapshotError('Snapshot of longer file')
+            if (header.get('inode'), header['size'], header['mtime']) == \
+                    (stat.st_ino, stat.st_size, stat.st_mtime):
+                digest = None
+            else:
+                digest = file_digest(self.path, header['offset'])
+                if digest.hexdigest() != header['sha1']:
+                    raise SnapshotError('Snapshot of different file')
+            tail = tail_digest(self.path, header['offset'])
+            if tail != header['tail']:
+                raise SnapshotError('Snapshot of different file')
+        except (EnvironmentError, SnapshotError) as error:
+            log.info('Not using snapshot %s: %s', snapshot, error)
+            return
+        log.info(
+            'Restored %d presence rows from %s', data.rows_count, snapshot,
+        )
+        self.offset, self.data, self.digest = header['offset'], data, digest
+        self.tail = tail
+
+    def save(self, snapshot):
+        """
+        Writes snapshot of loaded data. Failures are only logged.
+        """
+        try:
+            write_snapshot(snapshot, self.data, {
+                'inode': self.identity[1],
+                'size': self.size,
+                'mtime': self.mtime,
+                'offset': self.offset,
+                'sha1': self.digest.hexdigest(),
+                'tail': self.tail,
+            })
+        except EnvironmentError:
+            log.exception('Writing snapshot %s failed', snapshot)
+
+
+def split_ranges(path, start, end, parts):
+    """
+    Splits [start, end) bytes of file into at most given amount of
+    (start, end) ranges of similar size beginning at line boundaries.
+    """
+    bounds = [start]
+    with open(path, 'rb') as datafile:
+        for part in range(1, parts):
+            position = start + (end - start) * part // parts
+            if position <= bounds[-1]:
+                continue
+            # line starting right at position is found too
+            datafile.seek(position - 1)
+            datafile.readline()
+            position = datafile.tell()
+            if position >= end:
+                break
+            bounds.append(position)
+    bounds.append(end)
+    return zip(bounds, bounds[1:])
+
+
+def mapped_lines(mapped, end):
+    """
+    Yields lines of memory mapped file from its position up to end.
+    """
+    while mapped.tell() < end:
+        yield mapped.readline()
+
+
+def parse_byte_range(byte_range):
+    """
+    Parses (path, start, end) byte range of presence CSV file.
+
+    Returns (frozen users, see PresenceDataBuilder.freeze, consumed bytes,
+    statistics). Run in worker processes by parse_parallel, so sorting
+    and weekday aggregates are computed in parallel too.
+    """
+    path, start, end = byte_range
+    builder = PresenceDataBuilder()
+    lines = []
+    with open(path, 'rb') as csvfile:
+        mapped = mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            mapped.seek(start)
+            stats = parse_presence_lines(
+                complete_lines(mapped_lines(mapped, end), lines), builder,
+            )
+        finally:
+            mapped.close()
+    return builder.freeze(), sum(lines), stats
+
+
+def parse_parallel(path, start, end, workers):
+    """
+    Parses [start, end) bytes of presence CSV file in a pool of worker
+    processes, one line aligned byte range per worker.
+
+    Parts are merged in file order, so the result is the same as parsing
+    the file serially. Returns (list of frozen parts, see build_from_parts,
+    consumed bytes, statistics).
+
+    It forks, so it must not be called while other threads may hold locks
+    (e.g. from request threads); it's meant for offline precompute job.
+    """
+    started = time.time()
+    ranges = [
+        (path, range_start, range_end)
+        for range_start, range_end in split_ranges(path, start, end, workers)
+    ]
+    pool = multiprocessing.Pool(min(workers, len(ranges)))
+    try:
+        results = pool.map(parse_byte_range, ranges)
+    finally:
+        pool.close()
+        pool.join()
+
+    parts = []
+    consumed = 0
+    stats = {'rows': 0, 'skipped': 0, 'invalid': 0, 'slow': 0}
+    for part, range_consumed, range_stats in results:
+        parts.append(part)
+        consumed += range_consumed
+        for key in stats:
+            stats[key] += range_stats[key]
+    stats['workers'] = len(ranges)
+    stats['seconds'] = time.time() - started
+    stats['rows_per_second'] = stats['rows'] / max(stats['seconds'], 1e-9)
+    return parts, consumed, stats
+
+
+def complete_lines(csvfile, consumed):
+    """
+    Yields lines of file, appending length of every complete one
+    to consumed list.
+
+    Trailing line without newline is yielded too, but it isn't counted as
+    consumed, so it's parsed again once writer finishes it.
+    """
+    for line in csvfile:
+        if line.endswith('\n'):
+            consumed.append(len(line))
+        yield line
+
+
+LOADER = PresenceLoader()
+
+
+def parse_date(text, cache):
+    """
+    Converts 'YYYY-MM-DD' into date ordinal without strptime.
+    Returns None if text doesn't match the layout.
+    """
+    try:
+        return cache[text]
+    except KeyError:
+        pass
+    year, month, day = text[:4], text[5:7], text[8:]
+    # int() would accept signs and whitespace strptime rejects
+    if len(text) != 10 or text[4] != '-' or text[7] != '-' \
+            or not (year.isdigit() and month.isdigit() and day.isdigit()):
+        return None
+    try:
+        ordinal = datetime(int(year), int(month), int(day)).toordinal()
+    except ValueError:
+        return None
+    cache[text] = ordinal
+    return ordinal
+
+
+def parse_time(text, cache):
+    """
+    Converts 'HH:MM:SS' into seconds since midnight without strptime.
+    Returns None if text doesn't match the layout.
+    """
+    try:
+        return cache[text]
+    except KeyError:
+        pass
+    fields = text[:2], text[3:5], text[6:]
+    if len(text) != 8 or text[2] != ':' or text[5] != ':' \
+            or not all(field.isdigit() for field in fields):
+        return None
+    hour, minute, second = [int(field) for field in fields]
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        return None
+    cache[text] = seconds = hour * 3600 + minute * 60 + second
+    return seconds
+
+
+def fast_parse_line(line, dates, times):
+    """
+    Parses 'user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS' line by slicing it.
+
+    Returns (user_id, date_ordinal, start, end) tuple or None if line
+    doesn't match the layout. Dates and times are cached in given dicts.
+    """
+    line = line.rstrip('\r\n')
+    if len(line) < 30 or line[-29] != ',' or line[-18] != ',' \
+            or line[-9] != ',':
+        return None
+    try:
+        user_id = int(line[:-29])
+    except ValueError:
+        return None
+    date = parse_date(line[-28:-18], dates)
+    start = parse_time(line[-17:-9], times)
+    end = parse_time(line[-8:], times)
+    if date is None or start is None or end is None:
+        return None
+    return user_id, date, start, end
+
+
+def strict_parse_row(row):
+    """
+    Parses CSV row with strptime. Raises ValueError or TypeError
+    for invalid rows.
+    """
+    user_id = int(row[0])
+    date = datetime.strptime(row[1], '%Y-%m-%d').date()
+    start = datetime.strptime(row[2], '%H:%M:%S').time()
+    end = datetime.strptime(row[3], '%H:%M:%S').time()
+    return (
+        user_id,
+        date.toordinal(),
+        seconds_since_midnight(start),
+        seconds_since_midnight(end),
+    )
+
+
+def parse_presence_lines(lines, builder, fast=True):
+    """
+    Parses presence CSV lines into given PresenceDataBuilder.
+
+    With fast flag lines matching the fixed layout are sliced directly,
+    the rest falls back to csv module and strptime. Returns statistics.
+    """
+    stats = {'rows': 0, 'skipped': 0, 'invalid': 0, 'slow': 0}
+    dates = {}
+    times = {}
+    started = time.time()
+    if fast:
+        rows = (
+            fast_parse_line(line, dates, times) or next(csv.reader([line]), [])
+            for line in lines
+        )
+    else:
+        rows = csv.reader(lines, delimiter=',')
+    for i, row in enumerate(rows):
+        if isinstance(row, list):
+            stats['slow'] += 1
             if len(row) != 4:
                 # ignore header and footer lines
+                stats['skipped'] += 1
                 continue
 
             try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
+                row = strict_parse_row(row)
             except (ValueError, TypeError):
                 log.debug('Problem with line %d: ', i, exc_info=True)
+                stats['invalid'] += 1
+                continue
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+        builder.add(*row)
+        stats['rows'] += 1
 
-    return data
+    stats['seconds'] = time.time() - started
+    stats['rows_per_second'] = stats['rows'] / max(stats['seconds'], 1e-9)
+    return stats
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Approximates memory used by object together with everything it refers to.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (basestring, array)):
+        return size
+    if isinstance(obj, dict):
+        size += sum(
+            deep_sizeof(key, seen) + deep_sizeof(value, seen)
+            for key, value in obj.iteritems()
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    for name in getattr(type(obj), '__slots__', ()):
+        size += deep_sizeof(getattr(obj, name, None), seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
 
 
 def group_by_weekday(items):
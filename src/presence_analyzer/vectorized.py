@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Statistics of all users computed at once with NumPy.
+
+Entries of all users are grouped by (user, weekday) keys and reduced with
+bincount instead of going through every user separately. Results are the
+same as presence_analyzer.stats functions give for a single user. Without
+NumPy installed statistics are computed user by user.
+"""
+import calendar
+
+from presence_analyzer import stats
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+DAY = 24 * 3600
+
+
+def times_of_day(seconds):
+    """
+    Vectorized stats.time_of_day, returns array of [hour, minute, second].
+    """
+    # time.gmtime truncates fractions of second towards zero
+    seconds = numpy.trunc(seconds).astype(numpy.int64) % DAY
+    return numpy.column_stack(
+        (seconds // 3600, seconds // 60 % 60, seconds % 60),
+    )
+
+
+def weekday_arrays(data, user_ids):
+    """
+    Aggregates entries of given users into (users, 7) shaped arrays:
+    count, total, mean_start, mean_end, start_variance and end_variance.
+    """
+    columns = [data[user_id].columns() for user_id in user_ids]
+    size = len(user_ids) * 7
+    if not size:
+        empty = numpy.zeros((0, 7))
+        return dict.fromkeys(
+            ('count', 'total', 'mean_start', 'mean_end',
+             'start_variance', 'end_variance'),
+            empty,
+        )
+    lengths = [len(dates) for dates, _, _ in columns]
+    # pylint can't infer numpy results
+    # pylint: disable=assignment-from-no-return,no-member
+    dates = numpy.concatenate([column[0] for column in columns])
+    starts = numpy.concatenate([column[1] for column in columns])
+    ends = numpy.concatenate([column[2] for column in columns])
+    keys = numpy.repeat(
+        numpy.arange(len(user_ids), dtype=numpy.int64) * 7, lengths,
+    ) + (dates.astype(numpy.int64) + 6) % 7
+
+    count = numpy.bincount(keys, minlength=size)
+    divisor = numpy.maximum(count, 1)
+    result = {
+        'count': count,
+        'total': numpy.bincount(
+            keys, weights=ends - starts, minlength=size,
+        ).astype(numpy.int64),
+    }
+    for name, values in (('start', starts), ('end', ends)):
+        mean = numpy.bincount(keys, weights=values, minlength=size) / divisor
+        deviations = values - mean[keys]
+        result['mean_' + name] = mean
+        result[name + '_variance'] = numpy.bincount(
+            keys, weights=deviations * deviations, minlength=size,
+        ) / divisor
+    return {
+        name: values.reshape(len(user_ids), 7)
+        for name, values in result.iteritems()
+    }
+
+
+def all_users_stats(data, metrics=None):
+    """
+    Returns ``{user_id: {metric: result}}`` for all users and given
+    stats.METRICS names (all of them by default).
+    """
+    metrics = metrics or sorted(stats.METRICS)
+    user_ids = data.keys()
+    if numpy is None:
+        return {
+            user_id: {
+                metric: stats.METRICS[metric](data[user_id].weekdays)
+                for metric in metrics
+            }
+            for user_id in user_ids
+        }
+
+    arrays = weekday_arrays(data, user_ids)
+    count = arrays['count'].tolist()
+    total = arrays['total'].tolist()
+    mean_interval = (
+        arrays['total'] / numpy.maximum(arrays['count'], 1.0)
+    ).tolist()
+    start_sigma = numpy.sqrt(arrays['start_variance'])
+    end_sigma = numpy.sqrt(arrays['end_variance'])
+    # pylint: disable=no-member
+    times = {
+        name: times_of_day(values.ravel()).reshape(
+            len(user_ids), 7, 3,
+        ).tolist()
+        for name, values in (
+            ('start', arrays['mean_start']),
+            ('end', arrays['mean_end']),
+            ('start_low', arrays['mean_start'] - start_sigma),
+            ('start_high', arrays['mean_start'] + start_sigma),
+            ('end_low', arrays['mean_end'] - end_sigma),
+            ('end_high', arrays['mean_end'] + end_sigma),
+        )
+    }
+    days = range(7)
+    day_abbr = list(calendar.day_abbr)
+
+    result = {}
+    for idx, user_id in enumerate(user_ids):
+        user_result = result[user_id] = {}
+        if 'mean_time_weekday' in metrics:
+            user_result['mean_time_weekday'] = [
+                (
+                    day_abbr[day],
+                    mean_interval[idx][day] if count[idx][day] else 0,
+                )
+                for day in days
+            ]
+        if 'presence_weekday' in metrics:
+            user_result['presence_weekday'] = [
+                ('Weekday', 'Presence (s)'),
+            ] + [(day_abbr[day], total[idx][day]) for day in days]
+        if 'presence_start_end' in metrics:
+            user_result['presence_start_end'] = {
+                day: {
+                    'start': times['start'][idx][day],
+                    'end': times['end'][idx][day],
+                }
+                for day in days
+            }
+        if 'standard_deviation' in metrics:
+            user_result['standard_deviation'] = {
+                day: {
+                    'start_variation': [
+                        times['start_low'][idx][day],
+                        times['start_high'][idx][day],
+                    ],
+                    'end_variation': [
+                        times['end_low'][idx][day],
+                        times['end_high'][idx][day],
+                    ],
+                }
+                for day in days
+            }
+    return result
@@ -3,27 +3,24 @@
 Defines views.
 """
 # pylint: disable=no-name-in-module,import-error
-import calendar
-import locale
 import logging
-import operator
-import time
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+from json import dumps
 
-from flask import abort, redirect
+from flask import Response, abort, redirect, request
 from flask.ext.mako import exceptions, render_template
-from lxml import etree
 
+from presence_analyzer import metrics, stats, warmup
 from presence_analyzer.main import app
+from presence_analyzer.users import get_users_index, users_data_source
 from presence_analyzer.utils import (
+    data_version,
+    encode,
     get_data,
-    group_by_weekday,
     jsonify,
-    mean,
-    seconds_since_midnight,
-    get_mean_start_end,
-    variation_for_day_start_end,
-    standard_deviation_from_data,
+    lru_memorize,
 )
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -37,6 +34,44 @@ def mainpage():
     return redirect('/presence_weekday')
 
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    Liveness check, answers as long as the worker serves requests.
+    """
+    return Response(dumps({'status': 'ok'}), mimetype='application/json')
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    Readiness check, 503 Service Unavailable until warm-up is finished.
+
+    Doesn't touch any data, so it never waits for loading.
+    """
+    state = warmup.STATE
+    return Response(
+        dumps({
+            'ready': state['ready'],
+            'warm_up': {
+                'seconds': state['seconds'],
+                'steps': state['steps'],
+                'error': state['error'],
+            },
+        }),
+        status=200 if state['ready'] else 503,
+        mimetype='application/json',
+    )
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Application metrics in Prometheus text format.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/api/v1/users', methods=['GET'])
 @jsonify
 def users_view_v1():
@@ -51,34 +86,56 @@ def users_view_v1():
 
 
 @app.route('/api/v2/users', methods=['GET'])
-@jsonify
+@jsonify(sources=(users_data_source,))
 def users_view_v2():
     """
     Users listing for dropdown.
     """
-    # pylint: disable=no-member
-    with open(app.config['USERS_XML_FILE'], 'r') as usersxmlfile:
-        tree = etree.parse(usersxmlfile)
-    url_base = "{}://{}".format(
-        tree.find('server').findtext('protocol'),
-        tree.find('server').findtext('host'),
-    )
-    data = [
-        {
-            'user_id': elem.get('id'),
-            'name': elem.findtext('name'),
-            'avatar': '{}{}'.format(url_base, elem.findtext('avatar')),
-        }
-        for elem in tree.findall('./users/user')
-    ]
-    locale.setlocale(locale.LC_COLLATE, "")
-    data.sort(key=operator.itemgetter('name'), cmp=locale.strcoll)
-    return data
+    return get_users_index().body
+
+
+def requested_date(name):
+    """
+    Returns date ordinal of query argument given as YYYY-MM-DD, None if
+    it's missing. Aborts with 400 for malformed date.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+    except ValueError:
+        abort(400)
+
+
+def requested_range():
+    """
+    Returns (first, last) date ordinals from 'from' and 'to' query
+    arguments, see requested_date.
+    """
+    return requested_date('from'), requested_date('to')
+
+
+def date_range(function):
+    """
+    Passes requested date range to wrapped view as first and last keyword
+    arguments, so it's part of lru_memorize key.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        kwargs['first'], kwargs['last'] = requested_range()
+        return function(*args, **kwargs)
+    return inner
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
 @jsonify
-def mean_time_weekday_view(user_id):
+@date_range
+@lru_memorize(version=data_version)
+def mean_time_weekday_view(user_id, first=None, last=None):
     """
     Returns mean presence time of given user grouped by weekday.
     """
@@ -87,18 +144,16 @@ def mean_time_weekday_view(user_id):
         log.debug('User %s not found!', user_id)
         return 'NO_USER_DATA'
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    return result
+    return stats.mean_time_weekday(
+        data[user_id].weekdays_between(first, last),
+    )
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
 @jsonify
-def presence_weekday_view(user_id):
+@date_range
+@lru_memorize(version=data_version)
+def presence_weekday_view(user_id, first=None, last=None):
     """
     Returns total presence time of given user grouped by weekday.
     """
@@ -107,19 +162,16 @@ def presence_weekday_view(user_id):
         log.debug('User %s not found!', user_id)
         return 'NO_USER_DATA'
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return stats.presence_weekday(
+        data[user_id].weekdays_between(first, last),
+    )
 
 
 @app.route('/api/v1/standard_deviation/<int:user_id>', methods=['GET'])
 @jsonify
-def standard_deviation(user_id):
+@date_range
+@lru_memorize(version=data_version)
+def standard_deviation(user_id, first=None, last=None):
     """
     Returns standard deviation of user start and end work time
     of each working day.
@@ -161,26 +213,16 @@ def standard_deviation(user_id):
         log.debug('User %s not found!', user_id)
         return 'NO_USER_DATA'
 
-    day_start_end = {}
-    for day_idx in range(7):
-        day_start_end[day_idx] = defaultdict(lambda: 0)
-
-    weekdays = get_mean_start_end(data[user_id])
-
-    day_start_end = variation_for_day_start_end(
-        day_start_end,
-        data[user_id],
-        weekdays,
+    return stats.standard_deviation(
+        data[user_id].weekdays_between(first, last),
     )
 
-    day_start_end = standard_deviation_from_data(day_start_end, weekdays)
-
-    return day_start_end
-
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
 @jsonify
-def presence_start_end(user_id):
+@date_range
+@lru_memorize(version=data_version)
+def presence_start_end(user_id, first=None, last=None):
     """
     Returns total presence time of given user grouped by weekday.
     """
@@ -189,31 +231,99 @@ def presence_start_end(user_id):
         log.debug('User %s not found!', user_id)
         return 'NO_USER_DATA'
 
-    weekdays = {x: {'start': [], 'end': []} for x in range(7)}
-
-    for day in data[user_id].keys():
-        weekdays[day.weekday()]['start'].append(
-            seconds_since_midnight(data[user_id][day]['start'])
-        )
-        weekdays[day.weekday()]['end'].append(
-            seconds_since_midnight(data[user_id][day]['end'])
-        )
-    for day_idx in weekdays.keys():
-        start_time_tuple = time.gmtime(mean(weekdays[day_idx]['start']))
-        end_time_tuple = time.gmtime(mean(weekdays[day_idx]['end']))
-        weekdays[day_idx]['start'] = [
-            start_time_tuple.tm_hour,
-            start_time_tuple.tm_min,
-            start_time_tuple.tm_sec,
-        ]
+    return stats.presence_start_end(
+        data[user_id].weekdays_between(first, last),
+    )
+
 
-        weekdays[day_idx]['end'] = [
-            end_time_tuple.tm_hour,
-            end_time_tuple.tm_min,
-            end_time_tuple.tm_sec,
+def requested_metrics():
+    """
+    Returns metric names from comma separated 'metrics' query argument,
+    all metrics if it's missing. Aborts with 400 for unknown metrics.
+    """
+    metric_names = request.args.get('metrics')
+    metric_names = metric_names.split(',') if metric_names \
+        else sorted(stats.METRICS)
+    if any(metric not in stats.METRICS for metric in metric_names):
+        abort(400)
+    return metric_names
+
+
+@app.route('/api/v1/batch', methods=['GET'])
+@jsonify
+def batch_view():
+    """
+    Returns many metrics of many users at once, all computed from the same
+    data snapshot.
+
+    Users and metrics are given as comma separated user_ids and metrics
+    query arguments, all metrics are returned by default. Optional from
+    and to arguments (YYYY-MM-DD) limit entries to given dates. Result is
+    keyed by user and metric name, unknown users get 'NO_USER_DATA'.
+    """
+    try:
+        user_ids = [
+            int(user_id)
+            for user_id in request.args.get('user_ids', '').split(',')
+            if user_id
         ]
+    except ValueError:
+        abort(400)
+    metric_names = requested_metrics()
+    first, last = requested_range()
+    max_users = app.config.get('BATCH_MAX_USERS', 1000)
+    if not user_ids or len(user_ids) > max_users:
+        abort(400)
+
+    data = get_data()
+    result = {}
+    for user_id in user_ids:
+        if user_id not in data:
+            log.debug('User %s not found!', user_id)
+            result[user_id] = 'NO_USER_DATA'
+            continue
+        weekdays = data[user_id].weekdays_between(first, last, index=False)
+        result[user_id] = {
+            metric: stats.METRICS[metric](weekdays) for metric in metric_names
+        }
+    return result
+
 
-    return weekdays
+@app.route('/api/v1/summary', methods=['GET'])
+def summary_view():
+    """
+    Streams metrics of all users as newline delimited JSON, one user
+    per line, so memory use doesn't depend on amount of users.
+
+    Metrics and date range are chosen like in batch_view.
+    """
+    metric_names = requested_metrics()
+    first, last = requested_range()
+    data = get_data()
+    chunk_size = app.config.get('SUMMARY_CHUNK_USERS', 100)
+
+    def generate():
+        """
+        Yields chunks of serialized lines.
+        """
+        lines = []
+        for user_id in sorted(data):
+            weekdays = data[user_id].weekdays_between(
+                first, last, index=False,
+            )
+            line = {
+                metric: stats.METRICS[metric](weekdays)
+                for metric in metric_names
+            }
+            line['user_id'] = user_id
+            lines.append(encode(line))
+            if len(lines) == chunk_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
 
 
 @app.route('/<template>')
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Warm-up of caches before worker gets traffic.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# pylint: disable=no-name-in-module,import-error
+from flask.ext.mako import _lookup, exceptions
+
+from presence_analyzer.main import app
+from presence_analyzer.users import get_users_index
+from presence_analyzer.utils import get_data
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# ready is False only while warm-up is running or after it failed
+STATE = {
+    'ready': True,
+    'started': None,
+    'seconds': None,
+    'steps': None,
+    'error': None,
+}
+
+
+def compile_templates():
+    """
+    Compiles all Mako templates, so first page views don't wait for it.
+    Returns amount of compiled templates.
+    """
+    lookup = _lookup(app)  # pylint: disable=protected-access
+    compiled = 0
+    for directory in lookup.directories:
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.html'):
+                continue
+            try:
+                lookup.get_template(name)
+            except exceptions.MakoException:
+                log.warning('Template %s can not be compiled', name)
+                continue
+            compiled += 1
+    return compiled
+
+
+STEPS = (
+    ('presence_data', get_data),
+    ('users_index', get_users_index),
+    ('templates', compile_templates),
+)
+
+
+def warm_up():
+    """
+    Runs all warm-up steps. Returns their durations in seconds.
+    """
+    durations = OrderedDict()
+    for name, step in STEPS:
+        started = time.time()
+        step()
+        durations[name] = time.time() - started
+        log.info('Warm-up step %s took %.3fs', name, durations[name])
+    return durations
+
+
+def run():
+    """
+    Runs warm-up and records its outcome in STATE.
+    """
+    STATE.update(ready=False, started=time.time(), seconds=None, error=None)
+    try:
+        STATE['steps'] = warm_up()
+    except Exception as error:  # pylint: disable=broad-except
+        log.exception('Warm-up failed')
+        STATE['error'] = '{0}: {1}'.format(type(error).__name__, error)
+    else:
+        STATE['ready'] = True
+    STATE['seconds'] = time.time() - STATE['started']
+
+
+def start(background=True):
+    """
+    Starts warm-up, in a background thread unless told otherwise, so
+    the worker can answer health checks meanwhile.
+    """
+    STATE['ready'] = False
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name='warm-up')
+    thread.daemon = True
+    thread.start()
+    return thread